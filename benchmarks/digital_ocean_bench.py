@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 tw=0 et :
+
+'''
+Benchmark the DigitalOcean inventory script
+===========================================
+
+Runs ../inventory/DO/digital_ocean.py against the stand-in API server in
+fake_digital_ocean.py, for synthetic accounts of 10 to 10,000 droplets,
+and times each command in each cache state:
+
+    cold      no cache at all
+    warm      every cache segment present and valid
+    refresh   every cache segment present, with --refresh-cache
+
+for the commands --list, --host (by droplet name) and --all. The number of
+API requests each run made (and any 429 or 500 answers) is kept with the
+timing.
+
+The script is copied to a scratch directory with its own
+digital_ocean.ini (api_endpoint pointing at the server, cache_path in the
+scratch directory, every resource cached for an hour), so no API token or
+network access is needed. It is run with --python, which has to be a
+Python 2 with dopy installed (default: the Python running the benchmark).
+The server can be made slow (--latency), rate limited (--rate-limit) or
+unreliable (--error-rate), and --stream runs --list in streaming mode.
+
+Results are written as JSON (default: results/digital_ocean-<time>.json)
+so runs can be compared with --compare:
+
+    $ python2 benchmarks/digital_ocean_bench.py --sizes 10 1000 10000 --latency 0.1
+    $ python2 benchmarks/digital_ocean_bench.py --compare benchmarks/results/digital_ocean-20170301T120000.json
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_digital_ocean import FakeDigitalOcean, droplet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, '..', 'inventory', 'DO', 'digital_ocean.py')
+
+SIZES = [10, 100, 1000, 10000]
+COMMANDS = ['list', 'host', 'all']
+SCENARIOS = ['cold', 'warm', 'refresh']
+
+CONFIG = '''\
+[digital_ocean]
+api_token = benchmark
+api_endpoint = {endpoint}
+cache_path = {cache_path}
+cache_max_age = 3600
+cache_max_age_droplets = 3600
+'''
+
+
+###########################################################################
+# Scratch inventory
+###########################################################################
+
+class Inventory(object):
+    '''A copy of the script with its own digital_ocean.ini and cache'''
+
+    def __init__(self, python, endpoint, stream=False):
+        self.python = python
+        self.stream = stream
+        self.scratch = tempfile.mkdtemp(prefix='digital_ocean-bench-')
+        self.cache_path = os.path.join(self.scratch, 'cache')
+        self.script = os.path.join(self.scratch, 'digital_ocean.py')
+        shutil.copy(SCRIPT, self.script)
+        with open(os.path.join(self.scratch, 'digital_ocean.ini'), 'w') as f:
+            f.write(CONFIG.format(endpoint=endpoint, cache_path=self.cache_path))
+        # The environment would take precedence over digital_ocean.ini
+        self.env = dict(os.environ)
+        for name in ['DO_API_TOKEN', 'DO_API_KEY', 'DO_API_ENDPOINT']:
+            self.env.pop(name, None)
+
+    def command(self, command, refresh=False):
+        args = [self.python, self.script]
+        if command == 'host':
+            args += ['--host', droplet(0)['name']]
+        else:
+            args.append('--' + command)
+        if command == 'list' and self.stream:
+            args.append('--stream')
+        if refresh:
+            args.append('--refresh-cache')
+        return args
+
+    def run(self, args):
+        process = subprocess.Popen(args, env=self.env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('exit status {0}: {1}'.format(
+                process.returncode, err.decode('utf-8', 'replace').strip()[-200:]))
+        return out
+
+    def clear(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+        os.makedirs(self.cache_path)
+
+    def prime(self):
+        '''Fill every cache segment, the stored --list output included'''
+        self.clear()
+        self.run(self.command('all'))
+        self.run(self.command('list'))
+
+    def remove(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+###########################################################################
+# Measurement
+###########################################################################
+
+def measure(inventory, fake, command, scenario, repeat):
+    '''Return the best and mean wall time of repeat runs, and the API
+    requests they made'''
+    if scenario != 'cold':
+        inventory.prime()
+    args = inventory.command(command, refresh=(scenario == 'refresh'))
+    times = []
+    requests = {}
+    for i in range(repeat):
+        if scenario == 'cold':
+            inventory.clear()
+        fake.reset()
+        start = time.time()
+        inventory.run(args)
+        times.append(time.time() - start)
+        for name, count in fake.requests.items():
+            requests[name] = requests.get(name, 0) + count
+    return {
+        'best': min(times),
+        'mean': sum(times) / len(times),
+        'requests': sum([count for name, count in requests.items()
+                         if name not in ('limited', 'failed')]) / float(repeat),
+        'limited': requests.get('limited', 0) / float(repeat),
+        'failed': requests.get('failed', 0) / float(repeat),
+    }
+
+
+def run(args):
+    results = []
+    for size in args.sizes:
+        fake = FakeDigitalOcean(droplets=size, latency=args.latency,
+                                rate_limit=args.rate_limit, rate_window=args.rate_window,
+                                error_rate=args.error_rate).start()
+        inventory = Inventory(args.python, fake.url, stream=args.stream)
+        try:
+            for command in args.commands or COMMANDS:
+                for scenario in args.scenarios or SCENARIOS:
+                    record = {'command': command, 'scenario': scenario, 'size': size}
+                    try:
+                        record.update(measure(inventory, fake, command, scenario, args.repeat))
+                    except Exception as e:
+                        record['error'] = '{0}: {1}'.format(e.__class__.__name__, str(e))
+                    results.append(record)
+                    _print_record(record)
+        finally:
+            inventory.remove()
+            fake.stop()
+    return results
+
+
+###########################################################################
+# Reporting
+###########################################################################
+
+def _label(record):
+    return '--{command:<5} {scenario:<8} {size:>6} droplets'.format(**record)
+
+
+def _print_record(record, baseline=None):
+    if 'error' in record:
+        print('{0}  ERROR {1}'.format(_label(record), record['error']))
+        return
+    line = '{0}  best {1:8.4f}s  mean {2:8.4f}s  {3:6.1f} requests'.format(
+        _label(record), record['best'], record['mean'], record['requests'])
+    if record['limited'] or record['failed']:
+        line += '  ({0:.1f} limited, {1:.1f} failed)'.format(record['limited'], record['failed'])
+    if baseline is not None and 'best' in baseline:
+        line += '  (x{0:.2f})'.format(record['best'] / max(baseline['best'], 1e-9))
+    print(line)
+
+
+def _key(record):
+    return (record['command'], record['scenario'], record['size'])
+
+
+def compare(current, previous):
+    '''Print current results relative to a previous run'''
+    old = dict([(_key(r), r) for r in previous['results']])
+    print('\nRelative to {0} (ratio > 1 is slower):'.format(previous.get('started', '?')))
+    for record in current['results']:
+        _print_record(record, old.get(_key(record)))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DigitalOcean inventory script')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Droplet counts to generate (default: %(default)s)')
+    parser.add_argument('--command', choices=COMMANDS, action='append', dest='commands',
+                        help='Only time this command (may be repeated)')
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', dest='scenarios',
+                        help='Only time this cache state (may be repeated)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per measurement (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the server waits before each answer (default: %(default)s)')
+    parser.add_argument('--rate-limit', type=int, default=None,
+                        help='Requests the server allows per window (default: no limit)')
+    parser.add_argument('--rate-window', type=int, default=3600,
+                        help='Seconds in a rate limit window (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests the server fails with a 500 (default: %(default)s)')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Run --list with --stream')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python 2 with dopy to run the script with (default: %(default)s)')
+    parser.add_argument('--output', '-o', action='store',
+                        help='Results file (default: results/digital_ocean-<time>.json)')
+    parser.add_argument('--compare', action='store',
+                        help='Compare with the results of a previous run')
+    args = parser.parse_args()
+
+    started = time.strftime('%Y%m%dT%H%M%S')
+    results = run(args)
+
+    report = {
+        'benchmark': 'digital_ocean',
+        'started': started,
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': args.sizes,
+        'repeat': args.repeat,
+        'latency': args.latency,
+        'rate_limit': args.rate_limit,
+        'rate_window': args.rate_window,
+        'error_rate': args.error_rate,
+        'stream': args.stream,
+        'results': results,
+    }
+
+    output = args.output or os.path.join(HERE, 'results', 'digital_ocean-{0}.json'.format(started))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, sort_keys=True, indent=2)
+    print('[+] Results written to {0}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 tw=0 et :
+
+'''
+Benchmark the startup of the DigitalOcean inventory script
+==========================================================
+
+Ansible runs ../inventory/DO/digital_ocean.py with --list on every
+invocation. When the cached --list output is still valid, the script
+prints it before loading argparse, ConfigParser, requests or dopy. This
+benchmark times that against the full startup path serving the same
+cached output, for accounts of 10 to 10,000 droplets:
+
+    python    the interpreter starting and doing nothing, for reference
+    cached    --list, answered by the fast path
+    full      --list --force-cache, which goes through the whole script
+              (argument parsing, dopy, DoManager) and prints the same
+              cached output
+
+The script is copied to a scratch directory with its own
+digital_ocean.ini (cache_path in the scratch directory, droplets cached
+for a day) and a cache of synthetic droplets, so no API token or network
+access is needed. It is run with --python, which has to be a Python 2
+with dopy installed (default: the Python running the benchmark).
+
+Results are written as JSON (default: results/digital_ocean_startup-<time>.json)
+so runs can be compared with --compare:
+
+    $ python2 benchmarks/digital_ocean_startup_bench.py --sizes 10 1000 10000
+    $ python2 benchmarks/digital_ocean_startup_bench.py --compare benchmarks/results/digital_ocean_startup-20170301T120000.json
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, '..', 'inventory', 'DO', 'digital_ocean.py')
+
+SIZES = [10, 100, 1000, 10000]
+MODES = ['python', 'cached', 'full']
+
+CONFIG = '''\
+[digital_ocean]
+api_token = benchmark
+cache_path = {cache_path}
+cache_max_age_droplets = 86400
+'''
+
+
+###########################################################################
+# Scratch inventory
+###########################################################################
+
+def _droplet(i):
+    '''A droplet as the v2 API returns it (with the IPs dopy adds)'''
+    public = '10.1.{0}.{1}'.format(i // 250, i % 250)
+    private = '10.2.{0}.{1}'.format(i // 250, i % 250)
+    return {
+        'id': 1000 + i,
+        'name': 'node{0:05d}'.format(i),
+        'status': 'active',
+        'memory': 1024,
+        'vcpus': 1,
+        'disk': 25,
+        'locked': False,
+        'created_at': '2017-03-01T12:00:00Z',
+        'features': ['private_networking'] if i % 3 == 0 else [],
+        'backup_ids': [],
+        'snapshot_ids': [],
+        'region': {'slug': ['nyc1', 'sfo2', 'ams3'][i % 3], 'name': 'Region'},
+        'size': {'slug': 's-1vcpu-1gb'},
+        'size_slug': 's-1vcpu-1gb',
+        'image': {'id': 5, 'slug': 'ubuntu-16-04-x64', 'name': '16.04.3 x64',
+                  'distribution': 'Ubuntu'},
+        'networks': {'v4': [{'type': 'public', 'ip_address': public},
+                            {'type': 'private', 'ip_address': private}]},
+        'ip_address': public,
+        'private_ip_address': private,
+    }
+
+
+def _make_inventory(python, size):
+    '''Return a scratch directory with the script, its digital_ocean.ini
+    and a cache of size droplets, with the --list output stored'''
+    scratch = tempfile.mkdtemp(prefix='digital_ocean-bench-')
+    cache_path = os.path.join(scratch, 'cache')
+    os.makedirs(cache_path)
+    shutil.copy(SCRIPT, scratch)
+    with open(os.path.join(scratch, 'digital_ocean.ini'), 'w') as f:
+        f.write(CONFIG.format(cache_path=cache_path))
+    with open(os.path.join(cache_path, 'ansible-digital_ocean-droplets.cache'), 'w') as f:
+        json.dump([_droplet(i) for i in range(size)], f, separators=(',', ':'))
+    # A --list run that has to build the inventory stores it
+    _run(_command(python, scratch, 'full'))
+    return scratch
+
+
+###########################################################################
+# Measurement
+###########################################################################
+
+def _command(python, scratch, mode):
+    if mode == 'python':
+        return [python, '-c', '']
+    script = os.path.join(scratch, 'digital_ocean.py')
+    if mode == 'cached':
+        return [python, script, '--list']
+    return [python, script, '--list', '--force-cache']
+
+
+def _run(command):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, stdout=devnull)
+
+
+def _time(command, repeat):
+    '''Return the best and mean wall time of repeat runs of command'''
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        _run(command)
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+
+def run(python, sizes, modes, repeat):
+    results = []
+    for size in sizes:
+        scratch = _make_inventory(python, size)
+        try:
+            for mode in modes:
+                record = {'mode': mode, 'size': size}
+                try:
+                    record.update(_time(_command(python, scratch, mode), repeat))
+                except Exception as e:
+                    record['error'] = '{0}: {1}'.format(e.__class__.__name__, str(e))
+                results.append(record)
+                _print_record(record)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+###########################################################################
+# Reporting
+###########################################################################
+
+def _print_record(record, baseline=None):
+    if 'error' in record:
+        print('{mode:<8} {size:>6} droplets  ERROR {error}'.format(**record))
+        return
+    line = '{mode:<8} {size:>6} droplets  best {best:8.4f}s  mean {mean:8.4f}s'.format(**record)
+    if baseline is not None and 'best' in baseline:
+        line += '  (x{0:.2f})'.format(record['best'] / max(baseline['best'], 1e-9))
+    print(line)
+
+
+def compare(current, previous):
+    '''Print current results relative to a previous run'''
+    old = dict([((r['mode'], r['size']), r) for r in previous['results']])
+    print('\nRelative to {0} (ratio > 1 is slower):'.format(previous.get('started', '?')))
+    for record in current['results']:
+        _print_record(record, old.get((record['mode'], record['size'])))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the DigitalOcean inventory script')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Droplet counts to generate (default: %(default)s)')
+    parser.add_argument('--mode', choices=MODES, action='append', dest='modes',
+                        help='Only time this kind of run (may be repeated)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Runs per measurement (default: %(default)s)')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Python 2 with dopy to run the script with (default: %(default)s)')
+    parser.add_argument('--output', '-o', action='store',
+                        help='Results file (default: results/digital_ocean_startup-<time>.json)')
+    parser.add_argument('--compare', action='store',
+                        help='Compare with the results of a previous run')
+    args = parser.parse_args()
+
+    started = time.strftime('%Y%m%dT%H%M%S')
+    results = run(args.python, args.sizes, args.modes or MODES, args.repeat)
+
+    report = {
+        'benchmark': 'digital_ocean_startup',
+        'started': started,
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': args.sizes,
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    output = args.output or os.path.join(HERE, 'results', 'digital_ocean_startup-{0}.json'.format(started))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, sort_keys=True, indent=2)
+    print('[+] Results written to {0}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
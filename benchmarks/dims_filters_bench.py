@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 tw=0 et :
+
+'''
+Benchmark the DIMS filter plugins at fleet scale
+================================================
+
+Runs every filter returned by FilterModule.filters() (see
+../filter_plugins/dims_filters.py) on generated inputs for groups of
+10 to 100,000 hosts, both as direct Python calls and rendered through a
+Jinja2 environment the way Ansible templates use them.
+
+Name lookups go to a local stub resolver (socket.gethostbyname is
+replaced with a function that derives an address from the name), so
+results don't depend on the DNS servers of the machine running the
+benchmark. Use --resolver-latency to make the stub behave like a slow
+resolver.
+
+Results are written as JSON (default: results/dims_filters-<time>.json)
+so runs can be compared with --compare:
+
+    $ python benchmarks/dims_filters_bench.py --sizes 10 1000 10000
+    $ python benchmarks/dims_filters_bench.py --compare benchmarks/results/dims_filters-20170301T120000.json
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import jinja2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'filter_plugins'))
+
+SIZES = [10, 100, 1000, 10000, 100000]
+
+
+###########################################################################
+# Inputs
+###########################################################################
+
+def _short_names(n):
+    return ['node{0:06d}'.format(i) for i in range(n)]
+
+
+def _fqdns(n):
+    return ['{0}.devops.local'.format(h) for h in _short_names(n)]
+
+
+def _ips(n):
+    return ['10.{0}.{1}.{2}'.format((i >> 16) & 255, (i >> 8) & 255, i & 255)
+            for i in range(n)]
+
+
+def _host_ips(n):
+    return dict(zip(_fqdns(n), _ips(n)))
+
+
+def _hostvars(n):
+    return dict([(host, {'zone_iface': {'local': 'eth1'},
+                         'net': {'iface': {'eth1': {'ip': ip}}}})
+                 for host, ip in zip(_fqdns(n), _ips(n))])
+
+
+def _zone_groups(n):
+    return {'groups': {'local': _fqdns(n)}, 'zones': ['local']}
+
+
+def _quorum_groups(n):
+    return {'groups': {'manager': _fqdns(min(n, 5))}}
+
+
+def _stub_address(name):
+    crc = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+    return '10.{0}.{1}.{2}'.format((crc >> 16) & 255, (crc >> 8) & 255, crc & 255)
+
+
+# How to exercise each filter: (mode, input generator, keyword arguments).
+# In 'list' mode the whole input is passed to one call of the filter, in
+# 'each' mode the filter is called once per item of the input. Keyword
+# arguments that depend on the size are given as a function of the size.
+INPUTS = {
+    'list_to_args': ('list', _ips, {}),
+    'list_to_string_args': ('list', _ips, {}),
+    'names_to_ips': ('list', _short_names, {'category': 'devops', 'deployment': 'local'}),
+    'resolve_names': ('list', _short_names, {'category': 'devops', 'deployment': 'local'}),
+    'initial_cluster': ('list', _fqdns, {}),
+    'initial_cluster_lookup_short': ('list', _short_names, {'category': 'devops', 'deployment': 'local'}),
+    'add_domain': ('list', _short_names, {'category': 'devops', 'deployment': 'local'}),
+    'ip_to_in_addr_arpa': ('each', _ips, {}),
+    'reverse_zones': ('list', _host_ips, {}),
+    'zone_address_map': ('list', _hostvars, _zone_groups),
+    'aggregate_cidrs': ('list', _ips, {}),
+    'ipset_restore': ('list', _ips, {'name': 'bench'}),
+    'source_match': ('list', _ips, {'name': 'bench'}),
+    'rolling_batches': ('list', _fqdns, _quorum_groups),
+    'lowercase': ('each', _fqdns, {}),
+    'uppercase': ('each', _fqdns, {}),
+}
+
+TEMPLATES = {
+    'list': '{{{{ data | {0}(**kwargs) }}}}',
+    'each': '{{% for item in data %}}{{{{ item | {0}(**kwargs) }}}}\n{{% endfor %}}',
+}
+
+
+###########################################################################
+# Measurement
+###########################################################################
+
+def _time(fn, repeat):
+    '''Return the best and mean wall time of repeat calls to fn()'''
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+
+def run(filters, sizes, repeat):
+    env = jinja2.Environment()
+    env.filters.update(filters)
+    results = []
+    for name in sorted(filters):
+        if name not in INPUTS:
+            print('[-] {0}: no input generator, skipped'.format(name), file=sys.stderr)
+            results.append({'filter': name, 'skipped': True})
+            continue
+        mode, generator, kwargs = INPUTS[name]
+        fn = filters[name]
+        template = env.from_string(TEMPLATES[mode].format(name))
+        for size in sizes:
+            data = generator(size)
+            options = kwargs(size) if callable(kwargs) else kwargs
+            if mode == 'list':
+                direct = lambda: fn(data, **options)
+            else:
+                direct = lambda: [fn(item, **options) for item in data]
+            record = {'filter': name, 'mode': mode, 'size': size}
+            try:
+                record['direct'] = _time(direct, repeat)
+                record['jinja2'] = _time(lambda: template.render(data=data, kwargs=options), repeat)
+            except Exception as e:
+                record['error'] = '{0}: {1}'.format(e.__class__.__name__, str(e))
+            results.append(record)
+            _print_record(record)
+    return results
+
+
+###########################################################################
+# Reporting
+###########################################################################
+
+def _print_record(record, baseline=None):
+    if 'error' in record:
+        print('{filter:<30} {size:>7}  ERROR {error}'.format(**record))
+        return
+    line = '{0:<30} {1:>7}  direct {2:10.6f}s  jinja2 {3:10.6f}s'.format(
+        record['filter'], record['size'],
+        record['direct']['best'], record['jinja2']['best'])
+    if baseline is not None and 'direct' in baseline:
+        line += '  (x{0:.2f} / x{1:.2f})'.format(
+            record['direct']['best'] / max(baseline['direct']['best'], 1e-9),
+            record['jinja2']['best'] / max(baseline['jinja2']['best'], 1e-9))
+    print(line)
+
+
+def compare(current, previous):
+    '''Print current results relative to a previous run'''
+    old = dict([((r['filter'], r.get('size')), r) for r in previous['results']])
+    print('\nRelative to {0} (ratio > 1 is slower):'.format(previous.get('started', '?')))
+    for record in current['results']:
+        if 'size' in record:
+            _print_record(record, old.get((record['filter'], record['size'])))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dims_filters filter plugins')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Host counts to generate (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Calls per measurement; the best is reported (default: %(default)s)')
+    parser.add_argument('--filter', action='append', dest='only',
+                        help='Only benchmark this filter (may be repeated)')
+    parser.add_argument('--resolver-latency', type=float, default=0.0,
+                        help='Seconds the stub resolver sleeps per lookup (default: %(default)s)')
+    parser.add_argument('--resolver-cache', action='store_true', default=False,
+                        help='Use the shared resolver cache (in a scratch file) instead of disabling it')
+    parser.add_argument('--output', '-o', action='store',
+                        help='Results file (default: results/dims_filters-<time>.json)')
+    parser.add_argument('--compare', action='store',
+                        help='Compare with the results of a previous run')
+    args = parser.parse_args()
+
+    scratch = None
+    if args.resolver_cache:
+        scratch = tempfile.mkstemp(prefix='dims_resolver-bench-', suffix='.json')[1]
+        os.environ['DIMS_RESOLVER_CACHE'] = scratch
+    else:
+        os.environ['DIMS_RESOLVER_CACHE'] = 'off'
+
+    def _stub_gethostbyname(name):
+        if args.resolver_latency:
+            time.sleep(args.resolver_latency)
+        return _stub_address(name)
+    socket.gethostbyname = _stub_gethostbyname
+
+    import dims_filters
+    filters = dims_filters.FilterModule().filters()
+    if args.only:
+        filters = dict([(k, v) for k, v in filters.items() if k in args.only])
+
+    started = time.strftime('%Y%m%dT%H%M%S')
+    try:
+        results = run(filters, args.sizes, args.repeat)
+    finally:
+        if scratch is not None:
+            os.unlink(scratch)
+
+    report = {
+        'benchmark': 'dims_filters',
+        'started': started,
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sizes': args.sizes,
+        'repeat': args.repeat,
+        'resolver_latency': args.resolver_latency,
+        'resolver_cache': args.resolver_cache,
+        'results': results,
+    }
+
+    output = args.output or os.path.join(HERE, 'results', 'dims_filters-{0}.json'.format(started))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, sort_keys=True, indent=2)
+    print('[+] Results written to {0}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 tw=0 et :
+
+'''
+Benchmark the dims_function lookup plugin
+=========================================
+
+Drives LookupModule.run() from ../lookup_plugins/dims_function.py the
+way Ansible does: the calls are spread over a number of forked worker
+processes, at increasing call counts and fork levels, for each backend
+(exec: one $DIMS/bin/dims.function per call, coprocess: one Bash per
+worker) and each kind of call:
+
+    bash      get_packer_box_name with native=False, so every call runs
+              in Bash and nothing is cached
+    cached    get_packer_box_name over 10 distinct argument sets, answered
+              from the per-process and per-run caches after the first call
+    native    get_hostname_from_fqdn, answered in Python
+    batch     the 'bash' calls of each worker as one batch=True lookup
+
+$DIMS points at a scratch directory holding a stub dims.function, a
+stub shflags and a stub function library defining only the functions
+above, so the numbers measure the plugin and process overhead rather than
+the time to source the real library. Use --library to source the real
+roles/base/files/dims_functions.sh instead.
+
+Each measurement runs with DIMS_FUNCTION_TRACE set, and the per-function
+summary it writes (calls by source, p95 latency, cache hit rate) is kept
+with the timing.
+
+Results are written as JSON (default: results/dims_function-<time>.json)
+so runs can be compared with --compare:
+
+    $ python benchmarks/dims_function_bench.py --calls 10 100 1000 --forks 1 5 25
+    $ python benchmarks/dims_function_bench.py --compare benchmarks/results/dims_function-20170301T120000.json
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'lookup_plugins'))
+
+CALLS = [10, 100, 1000]
+FORKS = [1, 5, 25]
+BACKENDS = ['exec', 'coprocess']
+WORKLOADS = ['bash', 'cached', 'native', 'batch']
+
+# Running dims.function once per call is slow; don't wait for it beyond this
+EXEC_MAX_CALLS = 100
+
+
+###########################################################################
+# Stub $DIMS
+###########################################################################
+
+STUB_SHFLAGS = '''\
+# Stand-in for shflags with just what dims.function needs
+FLAGS_TRUE=0
+FLAGS_FALSE=1
+DEFINE_boolean() { eval "FLAGS_${1//-/_}=\\${FLAGS_FALSE}"; }
+flags_help() { :; }
+FLAGS() { return 0; }
+'''
+
+STUB_FUNCTIONS = '''\
+# Stand-in for dims_functions.sh with just the functions the benchmark calls
+get_packer_box_name() { echo "packer_${1}-${2}_box_virtualbox"; }
+get_hostname_from_fqdn() { echo "${1%%.*}"; }
+'''
+
+STUB_DIMS_FUNCTION = '''\
+#!/bin/bash
+. $DIMS/lib/shflags
+. $DIMS/bin/dims_functions.sh
+eval $@
+'''
+
+
+def _make_dims(library=None):
+    '''Return a scratch $DIMS directory with the stub scripts in it'''
+    dims = tempfile.mkdtemp(prefix='dims_function-bench-')
+    os.makedirs(os.path.join(dims, 'bin'))
+    os.makedirs(os.path.join(dims, 'lib'))
+    with open(os.path.join(dims, 'lib', 'shflags'), 'w') as f:
+        f.write(STUB_SHFLAGS)
+    if library is not None:
+        shutil.copy(library, os.path.join(dims, 'bin', 'dims_functions.sh'))
+    else:
+        with open(os.path.join(dims, 'bin', 'dims_functions.sh'), 'w') as f:
+            f.write(STUB_FUNCTIONS)
+    script = os.path.join(dims, 'bin', 'dims.function')
+    with open(script, 'w') as f:
+        f.write(STUB_DIMS_FUNCTION)
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+    return dims
+
+
+###########################################################################
+# Measurement
+###########################################################################
+
+def _commands(workload, first, count):
+    if workload == 'cached':
+        return ['get_packer_box_name ubuntu 14.04.{0}'.format(i % 10)
+                for i in range(first, first + count)]
+    if workload == 'native':
+        return ['get_hostname_from_fqdn node{0:06d}.devops.local'.format(i)
+                for i in range(first, first + count)]
+    return ['get_packer_box_name ubuntu 14.04.{0}'.format(i)
+            for i in range(first, first + count)]
+
+
+def _worker(workload, first, count):
+    import dims_function
+    lookup = dims_function.LookupModule()
+    commands = _commands(workload, first, count)
+    if workload == 'batch':
+        results = lookup.run(commands, batch=True, native=False)
+        failed = [r['term'] for r in results if r['rc'] != 0]
+        if failed:
+            raise RuntimeError('failed: {0}'.format(', '.join(failed)))
+        return
+    for command in commands:
+        lookup.run([command], native=(workload != 'bash'))
+
+
+def measure(backend, workload, calls, forks):
+    '''Return the wall time of calls lookups spread over forks workers'''
+    os.environ['DIMS_FUNCTION_BACKEND'] = backend
+    share, extra = divmod(calls, forks)
+    workers = []
+    first = 0
+    start = time.time()
+    for i in range(forks):
+        count = share + (1 if i < extra else 0)
+        if not count:
+            continue
+        worker = multiprocessing.Process(target=_worker, args=(workload, first, count))
+        worker.start()
+        workers.append(worker)
+        first += count
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed:
+        raise RuntimeError('{0} of {1} workers failed'.format(len(failed), len(workers)))
+    return elapsed
+
+
+def run(backends, workloads, calls, forks, exec_max_calls):
+    results = []
+    for backend in backends:
+        for workload in workloads:
+            for count in calls:
+                for level in forks:
+                    record = {'backend': backend, 'workload': workload,
+                              'calls': count, 'forks': level}
+                    if backend == 'exec' and count > exec_max_calls:
+                        continue
+                    scratch = tempfile.mkdtemp(prefix='dims_function-run-')
+                    os.environ['DIMS_FUNCTION_RUN_CACHE'] = os.path.join(scratch, 'cache.json')
+                    os.environ['DIMS_FUNCTION_TRACE'] = os.path.join(scratch, 'trace.json')
+                    try:
+                        record['seconds'] = measure(backend, workload, count, level)
+                        record['per_call'] = record['seconds'] / count
+                        with open(os.environ['DIMS_FUNCTION_TRACE']) as f:
+                            trace = json.load(f)
+                        for entry in trace.values():
+                            entry.pop('samples', None)
+                        record['trace'] = trace
+                    except Exception as e:
+                        record['error'] = '{0}: {1}'.format(e.__class__.__name__, str(e))
+                    finally:
+                        shutil.rmtree(scratch, ignore_errors=True)
+                    results.append(record)
+                    _print_record(record)
+    return results
+
+
+###########################################################################
+# Reporting
+###########################################################################
+
+def _label(record):
+    return '{backend:<10} {workload:<7} {calls:>6} calls {forks:>3} forks'.format(**record)
+
+
+def _print_record(record, baseline=None):
+    if 'error' in record:
+        print('{0}  ERROR {1}'.format(_label(record), record['error']))
+        return
+    line = '{0}  {1:10.4f}s  {2:8.2f}ms/call'.format(
+        _label(record), record['seconds'], record['per_call'] * 1000)
+    if baseline is not None and 'seconds' in baseline:
+        line += '  (x{0:.2f})'.format(record['seconds'] / max(baseline['seconds'], 1e-9))
+    print(line)
+
+
+def _key(record):
+    return (record['backend'], record['workload'], record['calls'], record['forks'])
+
+
+def compare(current, previous):
+    '''Print current results relative to a previous run'''
+    old = dict([(_key(r), r) for r in previous['results']])
+    print('\nRelative to {0} (ratio > 1 is slower):'.format(previous.get('started', '?')))
+    for record in current['results']:
+        _print_record(record, old.get(_key(record)))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dims_function lookup plugin')
+    parser.add_argument('--calls', type=int, nargs='+', default=CALLS,
+                        help='Total lookups per measurement (default: %(default)s)')
+    parser.add_argument('--forks', type=int, nargs='+', default=FORKS,
+                        help='Worker processes to spread them over (default: %(default)s)')
+    parser.add_argument('--backend', choices=BACKENDS, action='append', dest='backends',
+                        help='Only benchmark this backend (may be repeated)')
+    parser.add_argument('--workload', choices=WORKLOADS, action='append', dest='workloads',
+                        help='Only benchmark this kind of call (may be repeated)')
+    parser.add_argument('--exec-max-calls', type=int, default=EXEC_MAX_CALLS,
+                        help='Skip the exec backend above this many calls (default: %(default)s)')
+    parser.add_argument('--library', action='store_const', default=None,
+                        const=os.path.join(HERE, '..', 'roles', 'base', 'files', 'dims_functions.sh'),
+                        help='Source the real dims_functions.sh instead of the stub')
+    parser.add_argument('--output', '-o', action='store',
+                        help='Results file (default: results/dims_function-<time>.json)')
+    parser.add_argument('--compare', action='store',
+                        help='Compare with the results of a previous run')
+    args = parser.parse_args()
+
+    # Loaded once here (with Ansible) so the forked workers don't each pay
+    # for the import
+    import dims_function
+
+    dims = _make_dims(args.library)
+    os.environ['DIMS'] = dims
+    os.environ.setdefault('PBR', os.path.abspath(os.path.join(HERE, '..')))
+
+    started = time.strftime('%Y%m%dT%H%M%S')
+    try:
+        results = run(args.backends or BACKENDS, args.workloads or WORKLOADS,
+                      args.calls, args.forks, args.exec_max_calls)
+    finally:
+        shutil.rmtree(dims, ignore_errors=True)
+
+    report = {
+        'benchmark': 'dims_function',
+        'started': started,
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'calls': args.calls,
+        'forks': args.forks,
+        'library': 'dims_functions.sh' if args.library else 'stub',
+        'results': results,
+    }
+
+    output = args.output or os.path.join(HERE, 'results', 'dims_function-{0}.json'.format(started))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, sort_keys=True, indent=2)
+    print('[+] Results written to {0}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
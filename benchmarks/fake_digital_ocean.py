@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 tw=0 et :
+
+'''
+A stand-in for the DigitalOcean v2 API
+======================================
+
+Serves a synthetic account over HTTP for the v2 endpoints DoManager (and
+so ../inventory/DO/digital_ocean.py) uses:
+
+    GET /v2/droplets/          paginated (page, per_page: default 20, at most 200)
+    GET /v2/droplets/<id>
+    GET /v2/regions/
+    GET /v2/images/
+    GET /v2/sizes/
+    GET /v2/account/keys       (ssh_keys)
+    GET /v2/domains/
+
+The lists are paginated the way the API does it (links.pages, meta.total).
+Every request needs an "Authorization: Bearer ..." header, though any token
+will do. Requests can be slowed down (--latency), limited to a number per
+window (--rate-limit, --rate-window; the RateLimit-Limit, -Remaining and
+-Reset headers are sent with every response, and a 429 once the limit is
+reached) and made to fail with a 500 some of the time (--error-rate).
+
+Point the inventory script at it with DO_API_ENDPOINT:
+
+    $ python benchmarks/fake_digital_ocean.py --droplets 1000 --latency 0.1 &
+    $ DO_API_ENDPOINT=http://127.0.0.1:8801 DO_API_TOKEN=fake inventory/DO/digital_ocean.py --list
+
+digital_ocean_bench.py runs it in a thread with FakeDigitalOcean.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+REGIONS = ['nyc1', 'nyc3', 'sfo2', 'ams3', 'lon1', 'fra1', 'tor1', 'sgp1']
+SIZES = ['s-1vcpu-1gb', 's-1vcpu-2gb', 's-2vcpu-4gb', 's-4vcpu-8gb']
+IMAGES = [
+    (29906, 'ubuntu-16-04-x64', '16.04.3 x64', 'Ubuntu'),
+    (30508, 'debian-8-x64', '8.9 x64', 'Debian'),
+    (31311, 'centos-7-x64', '7.4 x64', 'CentOS'),
+    (32000, None, 'devops-base-snapshot', 'Ubuntu'),
+]
+
+PER_PAGE = 20
+MAX_PER_PAGE = 200
+
+
+###########################################################################
+# Synthetic account
+###########################################################################
+
+def droplet(i):
+    '''Droplet number i of a synthetic account, as the API returns it'''
+    image_id, image_slug, image_name, distribution = IMAGES[i % len(IMAGES)]
+    size = SIZES[i % len(SIZES)]
+    public = '10.{0}.{1}.{2}'.format(64 + i // 65536, (i // 256) % 256, i % 256)
+    private = '10.{0}.{1}.{2}'.format(128 + i // 65536, (i // 256) % 256, i % 256)
+    return {
+        'id': 3000000 + i,
+        'name': 'node{0:05d}.devops.local'.format(i),
+        'memory': 1024,
+        'vcpus': 1,
+        'disk': 25,
+        'locked': False,
+        'status': 'off' if i % 50 == 49 else 'active',
+        'kernel': None,
+        'created_at': '2017-03-01T12:00:00Z',
+        'features': ['private_networking', 'ipv6'] if i % 3 == 0 else ['ipv6'],
+        'backup_ids': [],
+        'next_backup_window': None,
+        'snapshot_ids': [],
+        'volume_ids': [],
+        'tags': ['devops'] if i % 2 == 0 else [],
+        'image': {'id': image_id, 'slug': image_slug, 'name': image_name,
+                  'distribution': distribution, 'public': image_slug is not None,
+                  'type': 'snapshot', 'min_disk_size': 20},
+        'size': {'slug': size, 'memory': 1024, 'vcpus': 1, 'disk': 25,
+                 'transfer': 1.0, 'available': True},
+        'size_slug': size,
+        'networks': {'v4': [{'ip_address': public, 'netmask': '255.255.240.0',
+                             'gateway': '10.64.0.1', 'type': 'public'},
+                            {'ip_address': private, 'netmask': '255.255.0.0',
+                             'gateway': '10.128.0.1', 'type': 'private'}],
+                     'v6': []},
+        'region': {'slug': REGIONS[i % len(REGIONS)], 'name': REGIONS[i % len(REGIONS)],
+                   'available': True, 'features': ['private_networking'], 'sizes': SIZES},
+    }
+
+
+def account(droplets):
+    '''The resources of a synthetic account with the given number of droplets'''
+    return {
+        'droplets': [droplet(i) for i in range(droplets)],
+        'regions': [{'slug': slug, 'name': slug, 'available': True, 'sizes': SIZES,
+                     'features': ['private_networking', 'backups', 'ipv6']}
+                    for slug in REGIONS],
+        'images': [{'id': image_id, 'slug': slug, 'name': name, 'distribution': distribution,
+                    'public': slug is not None, 'regions': REGIONS, 'type': 'snapshot'}
+                   for image_id, slug, name, distribution in IMAGES],
+        'sizes': [{'slug': slug, 'memory': 1024, 'vcpus': 1, 'disk': 25,
+                   'available': True, 'regions': REGIONS} for slug in SIZES],
+        'ssh_keys': [{'id': 512190 + i, 'name': 'key{0}'.format(i),
+                      'fingerprint': '3b:16:bf:e4:8b:00:8b:b8:59:8c:a9:d3:f0:19:45:{0:02x}'.format(i),
+                      'public_key': 'ssh-rsa AAAA... key{0}'.format(i)} for i in range(3)],
+        'domains': [{'name': 'devops.local', 'ttl': 1800, 'zone_file': ''},
+                    {'name': 'devops.develop', 'ttl': 1800, 'zone_file': ''}],
+    }
+
+
+###########################################################################
+# Server
+###########################################################################
+
+# Paths, and the resource each lists
+ROUTES = [
+    (re.compile(r'^/v2/droplets/?$'), 'droplets'),
+    (re.compile(r'^/v2/regions/?$'), 'regions'),
+    (re.compile(r'^/v2/images/?$'), 'images'),
+    (re.compile(r'^/v2/sizes/?$'), 'sizes'),
+    (re.compile(r'^/v2/account/keys/?$'), 'ssh_keys'),
+    (re.compile(r'^/v2/domains/?$'), 'domains'),
+]
+DROPLET = re.compile(r'^/v2/droplets/(\d+)/?$')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.fake.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._reply(401, {'id': 'unauthorized', 'message': 'Unable to authenticate you.'})
+        limited, headers = fake.take()
+        if limited:
+            return self._reply(429, {'id': 'too_many_requests', 'message': 'API Rate limit exceeded.'}, headers)
+        if fake.fail():
+            return self._reply(500, {'id': 'server_error', 'message': 'Unexpected server-side error'}, headers)
+
+        match = DROPLET.match(url.path)
+        if match:
+            fake.count('droplet')
+            index = int(match.group(1)) - 3000000
+            if 0 <= index < len(fake.account['droplets']):
+                return self._reply(200, {'droplet': fake.account['droplets'][index]}, headers)
+            return self._reply(404, {'id': 'not_found',
+                                     'message': 'The resource you were accessing could not be found.'}, headers)
+
+        for pattern, resource in ROUTES:
+            if pattern.match(url.path):
+                fake.count(resource)
+                body = self._page(resource, url, parse_qs(url.query))
+                return self._reply(200, body, headers)
+
+        return self._reply(404, {'id': 'not_found',
+                                 'message': 'The resource you were accessing could not be found.'}, headers)
+
+    def _page(self, resource, url, query):
+        items = self.server.fake.account[resource]
+        try:
+            page = max(int(query.get('page', ['1'])[0]), 1)
+            per_page = min(max(int(query.get('per_page', [str(PER_PAGE)])[0]), 1), MAX_PER_PAGE)
+        except ValueError:
+            page, per_page = 1, PER_PAGE
+        last = max((len(items) + per_page - 1) // per_page, 1)
+        base = 'http://{0}{1}'.format(self.headers.get('Host'), url.path)
+
+        def link(number):
+            return '{0}?page={1}&per_page={2}'.format(base, number, per_page)
+
+        pages = {}
+        if page > 1:
+            pages['first'] = link(1)
+            pages['prev'] = link(page - 1)
+        if page < last:
+            pages['next'] = link(page + 1)
+            pages['last'] = link(last)
+        return {resource: items[(page - 1) * per_page:page * per_page],
+                'links': {'pages': pages} if pages else {},
+                'meta': {'total': len(items)}}
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeDigitalOcean(object):
+    '''A stand-in DigitalOcean v2 API server for a synthetic account.
+
+    start() serves it from a thread, at self.url; self.requests counts the
+    requests answered, by resource (and 'droplet' for single droplets,
+    'limited' for 429s, 'failed' for 500s).'''
+
+    def __init__(self, droplets=100, latency=0.0, rate_limit=None, rate_window=3600,
+                 error_rate=0.0, port=0, seed=0, verbose=False):
+        self.account = account(droplets)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.window_start = time.time()
+        self.window_count = 0
+        self.server = _Server(('127.0.0.1', port), _Handler)
+        self.server.fake = self
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = None
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def take(self):
+        '''Count a request against the rate limit. Returns whether it is
+        over the limit, and the RateLimit-* headers to send.'''
+        if self.rate_limit is None:
+            return False, {}
+        with self.lock:
+            now = time.time()
+            if now >= self.window_start + self.rate_window:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            limited = self.window_count > self.rate_limit
+            if limited:
+                self.requests['limited'] = self.requests.get('limited', 0) + 1
+            headers = {
+                'RateLimit-Limit': str(self.rate_limit),
+                'RateLimit-Remaining': str(max(self.rate_limit - self.window_count, 0)),
+                # Rounded up, so it is never before the window resets
+                'RateLimit-Reset': str(int(math.ceil(self.window_start + self.rate_window))),
+            }
+            return limited, headers
+
+    def fail(self):
+        with self.lock:
+            failed = self.error_rate and self.random.random() < self.error_rate
+            if failed:
+                self.requests['failed'] = self.requests.get('failed', 0) + 1
+            return failed
+
+    def reset(self):
+        '''Forget the requests counted so far, and start a new rate limit window'''
+        with self.lock:
+            self.requests = {}
+            self.window_start = time.time()
+            self.window_count = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic DigitalOcean account over the v2 API')
+    parser.add_argument('--port', type=int, default=8801,
+                        help='Port to listen on, at 127.0.0.1 (default: %(default)s)')
+    parser.add_argument('--droplets', type=int, default=100,
+                        help='Droplets in the account (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request (default: %(default)s)')
+    parser.add_argument('--rate-limit', type=int, default=None,
+                        help='Requests allowed per window before answering 429 (default: no limit)')
+    parser.add_argument('--rate-window', type=int, default=3600,
+                        help='Seconds in a rate limit window (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests to answer with a 500 (default: %(default)s)')
+    parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                        help='Log every request')
+    args = parser.parse_args()
+
+    fake = FakeDigitalOcean(droplets=args.droplets, latency=args.latency,
+                            rate_limit=args.rate_limit, rate_window=args.rate_window,
+                            error_rate=args.error_rate, port=args.port, verbose=args.verbose)
+    print('[+] Serving {0} droplets at {1}'.format(args.droplets, fake.url))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 tw=0 et :
+
+'''
+Tests for the DigitalOcean inventory script
+===========================================
+
+Runs ../inventory/DO/digital_ocean.py against the stand-in API server in
+fake_digital_ocean.py, the way digital_ocean_bench.py does (a copy of the
+script in a scratch directory with its own digital_ocean.ini), and checks
+its output and the API requests it makes for --list (with and without
+--stream), --host, cache expiry and the fallback on a stale cache.
+
+Run it with a Python 2 that has dopy installed:
+
+    $ python2 benchmarks/test_digital_ocean.py -v
+
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from fake_digital_ocean import FakeDigitalOcean, droplet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, '..', 'inventory', 'DO', 'digital_ocean.py')
+
+# More than one page of droplets (the script asks for 200 at a time)
+DROPLETS = 250
+
+CONFIG = '''\
+[digital_ocean]
+api_token = test
+api_endpoint = {endpoint}
+cache_path = {cache_path}
+cache_max_age = 3600
+cache_max_age_droplets = 600
+api_retries = 0
+'''
+
+
+class DigitalOceanInventoryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeDigitalOcean(droplets=DROPLETS).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        self.fake.error_rate = 0.0
+        self.scratch = tempfile.mkdtemp(prefix='digital_ocean-test-')
+        self.cache_path = os.path.join(self.scratch, 'cache')
+        os.makedirs(self.cache_path)
+        self.script = os.path.join(self.scratch, 'digital_ocean.py')
+        shutil.copy(SCRIPT, self.script)
+        with open(os.path.join(self.scratch, 'digital_ocean.ini'), 'w') as f:
+            f.write(CONFIG.format(endpoint=self.fake.url, cache_path=self.cache_path))
+        # The environment would take precedence over digital_ocean.ini
+        self.env = dict(os.environ)
+        for name in ['DO_API_TOKEN', 'DO_API_KEY', 'DO_API_ENDPOINT']:
+            self.env.pop(name, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def run_script(self, *args):
+        '''Run the script and return its exit status, output (parsed, if it
+        succeeded), standard error and the API requests it made'''
+        self.fake.reset()
+        process = subprocess.Popen([sys.executable, self.script] + list(args), env=self.env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode == 0:
+            out = json.loads(out.decode('utf-8'))
+        return process.returncode, out, err.decode('utf-8', 'replace'), dict(self.fake.requests)
+
+    def check_script(self, *args):
+        '''Run the script, which has to succeed, and return its output and requests'''
+        status, out, err, requests = self.run_script(*args)
+        self.assertEqual(status, 0, err)
+        return out, requests
+
+    def expire(self, resource):
+        '''Make the cache segment of a resource older than its maximum age'''
+        filename = os.path.join(self.cache_path, 'ansible-digital_ocean-%s.cache' % resource)
+        then = time.time() - 3600
+        os.utime(filename, (then, then))
+
+    def check_inventory(self, inventory):
+        hostvars = inventory['_meta']['hostvars']
+        self.assertEqual(len(inventory['all']['hosts']), DROPLETS)
+        self.assertEqual(len(hostvars), DROPLETS)
+        first = droplet(0)
+        self.assertEqual(hostvars[first['name']]['do_id'], first['id'])
+        self.assertIn(first['name'], inventory['region_' + first['region']['slug']]['hosts'])
+
+    def test_list(self):
+        inventory, requests = self.check_script('--list')
+        self.check_inventory(inventory)
+        self.assertEqual(requests, {'droplets': 2})
+
+        # Ansible's plain --list is answered from the cache
+        cached, requests = self.check_script()
+        self.assertEqual(cached, inventory)
+        self.assertEqual(requests, {})
+
+    def test_list_stream(self):
+        inventory, requests = self.check_script('--list')
+        shutil.rmtree(self.cache_path)
+        os.makedirs(self.cache_path)
+
+        streamed, requests = self.check_script('--list', '--stream')
+        self.assertEqual(streamed, inventory)
+        self.assertEqual(requests, {'droplets': 2})
+
+        cached, requests = self.check_script('--list')
+        self.assertEqual(cached, inventory)
+        self.assertEqual(requests, {})
+        droplets, requests = self.check_script('--droplets')
+        self.assertEqual(len(droplets['droplets']), DROPLETS)
+        self.assertEqual(requests, {})
+
+    def test_list_stream_compressed(self):
+        inventory, requests = self.check_script('--list')
+        streamed, requests = self.check_script('--list', '--stream', '--cache-compress', '--refresh-cache')
+        self.assertEqual(streamed, inventory)
+        cached, requests = self.check_script()
+        self.assertEqual(cached, inventory)
+        self.assertEqual(requests, {})
+
+    def test_host(self):
+        inventory, requests = self.check_script('--list')
+        name = droplet(3)['name']
+        hostvars = inventory['_meta']['hostvars'][name]
+
+        # From the cached --list output, by name or ID
+        variables, requests = self.check_script('--host', name)
+        self.assertEqual(variables, hostvars)
+        self.assertEqual(requests, {})
+        variables, requests = self.check_script('--host', str(hostvars['do_id']))
+        self.assertEqual(variables, hostvars)
+        self.assertEqual(requests, {})
+
+        # Only that droplet is fetched once the cache has expired
+        self.expire('droplets')
+        variables, requests = self.check_script('--host', name)
+        self.assertEqual(variables, hostvars)
+        self.assertEqual(requests, {'droplet': 1})
+
+        variables, requests = self.check_script('--host', 'no-such-droplet')
+        self.assertEqual(variables, {})
+        variables, requests = self.check_script('--host', '999999999')
+        self.assertEqual(variables, {})
+        self.assertEqual(requests, {'droplet': 1})
+
+    def test_cache_expiry(self):
+        self.check_script('--all')
+        data, requests = self.check_script('--all')
+        self.assertEqual(requests, {})
+
+        # Each segment expires on its own
+        self.expire('droplets')
+        data, requests = self.check_script('--all')
+        self.assertEqual(requests, {'droplets': 2})
+        self.assertEqual(len(data['droplets']), DROPLETS)
+
+        self.expire('regions')
+        data, requests = self.check_script('--regions')
+        self.assertEqual(requests, {'regions': 1})
+
+        data, requests = self.check_script('--regions', '--refresh-cache')
+        self.assertEqual(sorted(requests), ['domains', 'droplets', 'images', 'regions', 'sizes', 'ssh_keys'])
+
+    def test_stale_fallback(self):
+        inventory, requests = self.check_script('--list')
+        self.expire('droplets')
+        self.fake.error_rate = 1.0
+
+        status, out, err, requests = self.run_script('--list')
+        self.assertNotEqual(status, 0)
+        self.assertIn('Could not get droplets', err)
+
+        for args in (['--list'], ['--list', '--stream']):
+            stale, requests = self.check_script('--stale-max-age', '7200', *args)
+            self.assertEqual(stale, inventory)
+            self.assertEqual(requests, {'failed': 1})
+
+        status, out, err, requests = self.run_script('--list', '--stale-max-age', '60')
+        self.assertNotEqual(status, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
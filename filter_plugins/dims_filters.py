@@ -1,9 +1,294 @@
 # vim: set ts=4 sw=4 tw=0 et :
 
 from netaddr import *
+import collections
+import os
 import socket
+import sys
+import threading
+import time
 from ansible import errors
 
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+# Code shared with the other DIMS plugins
+_PLUGIN_UTILS = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, 'plugin_utils'))
+if _PLUGIN_UTILS not in sys.path:
+    sys.path.insert(0, _PLUGIN_UTILS)
+import dims_plugin_utils
+
+# Bulk name resolution defaults. Lookups run on a bounded pool of
+# threads; any single name that takes longer than RESOLVER_TIMEOUT
+# seconds, or is still pending RESOLVER_DEADLINE seconds after the
+# batch started, is reported as failed instead of stalling the render.
+RESOLVER_WORKERS = 16
+RESOLVER_TIMEOUT = 2.0
+RESOLVER_DEADLINE = 10.0
+
+# Resolver results are cached in a file shared by all forks of one
+# ansible run, in the run's private temporary directory (see
+# plugin_utils/dims_plugin_utils.py). A fork only waits for names that
+# another fork is looking up at that moment. Set DIMS_RESOLVER_CACHE to
+# a file name (a file only you can read and write) to share the cache
+# between consecutive runs as well, or to "off" to disable it.
+# Successful and failed lookups are kept for DIMS_RESOLVER_TTL and
+# DIMS_RESOLVER_NEGATIVE_TTL seconds, respectively, and the least
+# recently used entries are dropped beyond DIMS_RESOLVER_CACHE_SIZE.
+RESOLVER_CACHE_TTL = 300
+RESOLVER_CACHE_NEGATIVE_TTL = 30
+RESOLVER_CACHE_SIZE = 4096
+
+
+def _to_text(_str):
+    '''Return a unicode version of a (possibly byte) string'''
+    if isinstance(_str, bytes):
+        return _str.decode('utf-8')
+    return _str
+
+
+def _resolve_names(names,
+                   workers=RESOLVER_WORKERS,
+                   timeout=RESOLVER_TIMEOUT,
+                   deadline=RESOLVER_DEADLINE):
+    '''
+    Resolve a list of fully qualified names to IPv4 addresses in parallel.
+
+    Returns a tuple (addresses, failures) where addresses is a list in
+    the same order as the input (with None for names that could not be
+    resolved) and failures is a dictionary mapping each name that failed
+    to a short reason string. Duplicate names are only looked up once.
+
+    a = ['node01.devops.local', 'node02.devops.local', 'bogus.devops.local']
+    _resolve_names(a)
+    (['192.168.56.21', '192.168.56.22', None],
+     {'bogus.devops.local': '[Errno -2] Name or service not known'})
+
+    '''
+
+    results = {}
+    failures = {}
+    pending = collections.deque()
+    for name in names:
+        if name not in results:
+            pending.append(name)
+            results[name] = None
+
+    done = threading.Condition()
+    started = {}
+    state = {'stop': False}
+
+    def _worker():
+        while True:
+            with done:
+                if state['stop'] or not pending:
+                    return
+                name = pending.popleft()
+                started[name] = time.time()
+                done.notify()
+            try:
+                outcome = (True, socket.gethostbyname(name))
+            except Exception as e:
+                outcome = (False, str(e) or e.__class__.__name__)
+            with done:
+                if started.pop(name, None) is None:
+                    # Timed out and replaced by another worker
+                    return
+                if outcome[0]:
+                    results[name] = outcome[1]
+                else:
+                    failures[name] = outcome[1]
+                done.notify()
+
+    def _start_worker():
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+
+    expires = time.time() + deadline
+    with done:
+        for i in range(min(max(1, int(workers)), len(pending))):
+            _start_worker()
+        while True:
+            now = time.time()
+            # Abandon lookups that exceeded their own timeout. The (daemon)
+            # thread is left to finish on its own and a new one takes its
+            # place in the pool.
+            for name, since in list(started.items()):
+                if now - since >= timeout:
+                    del started[name]
+                    failures[name] = 'timed out after {0}s'.format(timeout)
+                    if pending:
+                        _start_worker()
+            if not pending and not started:
+                break
+            if now >= expires:
+                state['stop'] = True
+                for name in list(started.keys()) + list(pending):
+                    failures[name] = 'deadline of {0}s exceeded'.format(deadline)
+                started.clear()
+                pending.clear()
+                break
+            wait = min([since + timeout for since in started.values()] +
+                       [expires]) - now
+            done.wait(max(wait, 0.001))
+
+    return [results[name] for name in names], failures
+
+
+def _failed_lookup_message(what, failures):
+    '''Return a message describing names that failed to resolve'''
+    return '{0} could not resolve: {1}'.format(
+        what,
+        ', '.join(['{0} ({1})'.format(name, failures[name])
+                   for name in sorted(failures)]))
+
+
+_resolver_cache = None
+
+
+def _get_resolver_cache():
+    '''Return the shared resolver cache, or None if it is disabled'''
+    global _resolver_cache
+    path = os.getenv('DIMS_RESOLVER_CACHE')
+    if path is not None and path.lower() in ('', 'off', 'no', 'false', '0'):
+        return None
+    if path is None:
+        path = dims_plugin_utils.run_path('resolver.json')
+    if _resolver_cache is None or _resolver_cache.path != path:
+        _resolver_cache = dims_plugin_utils.SharedCache(
+            path,
+            max_entries=int(os.getenv('DIMS_RESOLVER_CACHE_SIZE', RESOLVER_CACHE_SIZE)),
+            wait=RESOLVER_DEADLINE + RESOLVER_TIMEOUT)
+    return _resolver_cache
+
+
+def _lookup_names(names):
+    '''Resolve names through the shared cache (if enabled)'''
+    cache = _get_resolver_cache()
+    if cache is None:
+        return _resolve_names(names)
+    ttl = float(os.getenv('DIMS_RESOLVER_TTL', RESOLVER_CACHE_TTL))
+    negative_ttl = float(os.getenv('DIMS_RESOLVER_NEGATIVE_TTL', RESOLVER_CACHE_NEGATIVE_TTL))
+
+    def compute(missing):
+        addresses, failures = _resolve_names(missing)
+        results = {}
+        for name, address in zip(missing, addresses):
+            if address is None:
+                results[name] = ([None, failures[name]], negative_ttl)
+            else:
+                results[name] = ([address, None], ttl)
+        return results
+
+    try:
+        entries = cache.get(names, compute)
+    except (IOError, OSError) as e:
+        display.vvv('resolver cache {0} unusable: {1}'.format(cache.path, str(e)))
+        return _resolve_names(names)
+    failures = dict([(n, entries[n][1]) for n in names if entries[n][0] is None])
+    return [entries[n][0] for n in names], failures
+
+
+class _InventoryIndex(object):
+    '''
+    Answer address lookups from inventory instead of DNS.
+
+    The address of a host is hostvars[host].net.iface[iface].ip, where
+    iface is given explicitly or selected by the host's zone_iface[zone]
+    (the same values the dns role uses to build its mappings). Only the
+    host names are read up front; each host's variables are templated
+    the first time its address is needed and the result is remembered.
+    '''
+
+    def __init__(self, hostvars, zone=None, iface=None):
+        self.hostvars = hostvars
+        self.zone = zone
+        self.iface = iface
+        self.hosts = {}
+        self.short = {}
+        for host in hostvars:
+            host = _to_text(host)
+            self.hosts[host] = False
+            self.short.setdefault(host.split('.')[0], []).append(host)
+
+    def fqdn(self, name):
+        '''Return the inventory host name for a name, or None'''
+        if name in self.hosts:
+            return name
+        candidates = self.short.get(name.split('.')[0], [])
+        if '.' not in name and len(candidates) == 1:
+            return candidates[0]
+        return None
+
+    def address(self, name):
+        '''Return the inventory address for a name, or None'''
+        host = self.fqdn(name)
+        if host is None or (self.zone is None and self.iface is None):
+            return None
+        if self.hosts[host] is False:
+            self.hosts[host] = self._address(host)
+        return self.hosts[host]
+
+    def _address(self, host):
+        try:
+            hv = self.hostvars[host]
+            iface = self.iface
+            if iface is None:
+                iface = (hv.get('zone_iface') or {}).get(self.zone)
+            return _to_text(hv['net']['iface'][iface]['ip']) or None
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+
+# Indexes are reused as long as the same hostvars object (i.e., the same
+# task in a given fork) is passed in. A reference is held to each hostvars
+# object so its id() can't be recycled while it is a key here.
+_inventory_indexes = []
+INVENTORY_INDEXES = 4
+
+
+def _get_inventory_index(hostvars, zone=None, iface=None):
+    '''Return a (memoized) _InventoryIndex for hostvars'''
+    for held, index in _inventory_indexes:
+        if held is hostvars and index.zone == zone and index.iface == iface:
+            return index
+    index = _InventoryIndex(hostvars, zone=zone, iface=iface)
+    _inventory_indexes.insert(0, (hostvars, index))
+    del _inventory_indexes[INVENTORY_INDEXES:]
+    return index
+
+
+def _lookup_names_with_inventory(names, hostvars=None, zone=None, iface=None):
+    '''
+    Resolve names from inventory when hostvars is provided, falling back
+    to DNS (through _lookup_names()) for names inventory doesn't cover.
+    '''
+    if hostvars is None:
+        return _lookup_names(names)
+    if zone is None and iface is None:
+        raise errors.AnsibleFilterError('A zone or iface is required to look up addresses in hostvars')
+    index = _get_inventory_index(hostvars, zone=zone, iface=iface)
+    addresses = [index.address(name) for name in names]
+    missing = [name for name, address in zip(names, addresses) if address is None]
+    if not missing:
+        return addresses, {}
+    display.vvv('inventory has no address for {0}, using DNS'.format(', '.join(missing)))
+    found, failures = _lookup_names(missing)
+    found = dict(zip(missing, found))
+    return [found[name] if address is None else address
+            for name, address in zip(names, addresses)], failures
+
+
 def _list_to_args(_list):
     '''
     Return a space separated list suitable for an argument list.
@@ -35,11 +320,15 @@ def _list_to_string_args(_list):
     else:
         return "{}".format(_list)
 
-def _add_domain(_list, category='devops', deployment='local'):
+def _add_domain(_list, category='devops', deployment='local', hostvars=None):
     '''
     Return an array of names with added domains (for instances
     where fully qualified domain names are required.)
 
+    If hostvars is passed, names that are already inventory host names are
+    left alone and short names that match exactly one inventory host are
+    replaced by that host's name.
+
     a = ['node01','node02','node03']
     _add_domain(a, category='devops', deployment='local')
     ['node01.devops.local', 'node02.devops.local', 'node03.devops.local']
@@ -47,6 +336,13 @@ def _add_domain(_list, category='devops', deployment='local'):
     '''
 
     if type(_list) == type([]):
+        if hostvars is not None:
+            index = _get_inventory_index(hostvars)
+            return [index.fqdn(_to_text(host)) or '{0}.{1}.{2}'.format(
+                        host,
+                        category,
+                        deployment
+                    ) for host in _list]
         return ['{0}.{1}.{2}'.format(
                     host,
                     category,
@@ -56,15 +352,26 @@ def _add_domain(_list, category='devops', deployment='local'):
         raise errors.AnsibleFilterError('Unrecognized input arguments to _add_domains()')
 
 
-def _initial_cluster_lookup_short(_list, category='devops', deployment='local', port=2380):
+def _initial_cluster_lookup_short(_list, category='devops', deployment='local', port=2380, strict=False,
+                                  hostvars=None, zone=None, iface=None):
     '''
     Return a comma (no spaces!) separated list of Consul initial cluster
     members. The "no spaces" is because this is used as a single command line
     argument.
 
-    This filter only works if DNS resolution is available. To prevent templating
-    errors, such a failure returns a null string. Calling programs can and should
-    check for this error before attempting to use the results.
+    This filter only works if DNS resolution is available. All names are
+    resolved at once through the shared resolver cache (see _lookup_names()).
+    To prevent templating errors, a failure to resolve any name returns a
+    null string and the names that failed are reported as a warning. Calling
+    programs can and should check for this error before attempting to use
+    the results. Use strict=True to raise an error naming the failed lookups
+    instead.
+
+    Passing hostvars (plus a zone or iface) takes addresses from inventory
+    (see _InventoryIndex) and only uses DNS for names inventory doesn't
+    cover, which also works before DNS is available.
+
+    {{ groups.consul | initial_cluster_lookup_short(hostvars=hostvars, zone='local') }}
 
     a = ['node01','node02','node03']
     _initial_cluster_lookup_short(a)
@@ -79,22 +386,22 @@ def _initial_cluster_lookup_short(_list, category='devops', deployment='local',
     '''
 
     if type(_list) == type([]):
-        try:
-            return ','.join(
-                ['{0}=http://{1}:{2}'.format(
-                    i.decode('utf-8'),
-                    socket.gethostbyname('{0}.{1}.{2}'.format(
-                        i.decode('utf-8'),
-                        category,
-                        deployment)
-                    ),
-                    port) for i in _list]
-            )
-        except Exception as e:
-            #raise errors.AnsibleFilterError(
-            #    'initial_cluster() could not perform lookups: {0}'.format(str(e))
-            #)
+        hosts = [_to_text(i) for i in _list]
+        addresses, failures = _lookup_names_with_inventory(
+                ['{0}.{1}.{2}'.format(i, category, deployment) for i in hosts],
+                hostvars=hostvars, zone=zone, iface=iface)
+        if failures:
+            msg = _failed_lookup_message('initial_cluster_lookup_short()', failures)
+            if strict:
+                raise errors.AnsibleFilterError(msg)
+            display.warning(msg)
             return ''
+        return ','.join(
+            ['{0}=http://{1}:{2}'.format(
+                host,
+                address,
+                port) for host, address in zip(hosts, addresses)]
+        )
     else:
         raise errors.AnsibleFilterError('Unrecognized input arguments to initial_cluster()')
 
@@ -115,8 +422,8 @@ def _initial_cluster(_list, port=2380):
         try:
             return ','.join(
                 ['{0}=http://{1}:{2}'.format(
-                    i.decode('utf-8').split('.')[0],
-                    i.decode('utf-8'),
+                    _to_text(i).split('.')[0],
+                    _to_text(i),
                     port) for i in _list]
             )
         except Exception as e:
@@ -128,13 +435,20 @@ def _initial_cluster(_list, port=2380):
         raise errors.AnsibleFilterError('Unrecognized input arguments to initial_cluster()')
 
 
-def _names_to_ips(_list, category='devops', deployment='local'):
+def _names_to_ips(_list, category='devops', deployment='local', strict=False,
+                  hostvars=None, zone=None, iface=None):
     '''
     Return an array of IP addresses resulting from lookups of names
     in the input array. This function assumes the input array consists
     of short hostnames and will convert them into fully qualified domain
     names to perform lookups.
 
+    All names are resolved at once through the shared resolver cache (see
+    _lookup_names()). If any name can't be resolved, a warning naming the
+    failed lookups is produced and a null string is returned (or an error is
+    raised if strict=True). As with initial_cluster_lookup_short, passing
+    hostvars plus a zone or iface answers from inventory first.
+
     a = ['node01','node02','node03']
     _names_to_ips(a)
     ['192.168.56.21', '192.168.56.22', '192.168.56.23']
@@ -142,31 +456,406 @@ def _names_to_ips(_list, category='devops', deployment='local'):
     '''
 
     if type(_list) == type([]):
-        try:
-            return ['{0}'.format(
-                    socket.gethostbyname('{0}.{1}.{2}'.format(
-                        i.decode('utf-8'),
-                        category,
-                        deployment)))
-                    for i in _list]
-        except Exception as e:
-            #raise errors.AnsibleFilterError(
-            #    '_names_to_ips() could not perform lookups: {0}'.format(str(e))
-            #)
+        addresses, failures = _lookup_names_with_inventory(
+                ['{0}.{1}.{2}'.format(_to_text(i), category, deployment)
+                 for i in _list],
+                hostvars=hostvars, zone=zone, iface=iface)
+        if failures:
+            msg = _failed_lookup_message('_names_to_ips()', failures)
+            if strict:
+                raise errors.AnsibleFilterError(msg)
+            display.warning(msg)
             return ''
+        return ['{0}'.format(address) for address in addresses]
     else:
         raise errors.AnsibleFilterError('Unrecognized input arguments to _names_to_ips()')
 
 
+def _resolve_names_filter(_list, category=None, deployment=None):
+    '''
+    Resolve a list of names in one batch and return both the addresses
+    (in input order, None for failures) and the names that failed. If
+    category and deployment are given, short names are converted to
+    fully qualified names before the lookup.
+
+    a = ['node01','node02','bogus']
+    _resolve_names_filter(a, category='devops', deployment='local')
+    {'addresses': ['192.168.56.21', '192.168.56.22', None],
+     'failed': {'bogus.devops.local': '[Errno -2] Name or service not known'}}
+
+    '''
+
+    if type(_list) == type([]):
+        names = [_to_text(i) for i in _list]
+        if category is not None and deployment is not None:
+            names = ['{0}.{1}.{2}'.format(i, category, deployment) for i in names]
+        addresses, failures = _lookup_names(names)
+        return {'addresses': addresses, 'failed': failures}
+    else:
+        raise errors.AnsibleFilterError('Unrecognized input arguments to resolve_names()')
+
+
+def _reverse_pointer(_str, ipv4_prefix=24, ipv6_prefix=124):
+    '''
+    Split the reverse lookup name of an IP address into its zone (the
+    first ipv4_prefix or ipv6_prefix bits of the address) and the PTR
+    record name within that zone.
+
+    Dotted quads are handled with string operations alone; anything else
+    (e.g., IPv6 addresses) is parsed with netaddr.
+
+    _reverse_pointer('192.168.56.21')
+    ('56.168.192.in-addr.arpa', '21')
+    _reverse_pointer('fd00::21', ipv6_prefix=64)
+    ('0.0.0.0.0.0.0.0.0.0.0.0.0.0.d.f.ip6.arpa', '1.2.0.0.0.0.0.0.0.0.0.0.0.0.0.0')
+
+    '''
+
+    parts = _str.split('.')
+    if (len(parts) == 4 and
+            all([p.isdigit() and int(p) < 256 and (p == '0' or p[0] != '0') for p in parts])):
+        keep = ipv4_prefix // 8
+        labels = parts[::-1]
+        return ('.'.join(labels[4 - keep:]) + '.in-addr.arpa',
+                '.'.join(labels[:4 - keep]))
+    address = IPAddress(_str)
+    labels = address.reverse_dns[:-1].split('.')
+    if address.version == 4:
+        split = 4 - ipv4_prefix // 8
+    else:
+        split = 32 - ipv6_prefix // 4
+    return '.'.join(labels[split:]), '.'.join(labels[:split])
+
+
 def _ip_to_in_addr_arpa(_str):
     '''Return the reverse lookup address for an IP address'''
 
     if isinstance(_str, basestring):
-        return IPAddress(_str).reverse_dns.split('.', 1)[-1][:-1]
+        return _reverse_pointer(_str)[0]
     else:
         return "{}".format(_str)
 
 
+def _reverse_zones(_data, ipv4_prefix=24, ipv6_prefix=64):
+    '''
+    Return a dictionary of reverse lookup zones, each holding the list of
+    PTR records that belong in it, for a list of IP addresses or a
+    dictionary mapping host names to an IP address (or list of addresses).
+    IPv4 zones cover ipv4_prefix bits (a multiple of 8) and IPv6 zones
+    ipv6_prefix bits (a multiple of 4). Records are in input order (host
+    name order for a dictionary); 'host' is None for list input.
+
+    a = {'red.devops.local': '192.168.56.30', 'node01.devops.local': '192.168.56.21'}
+    _reverse_zones(a)
+    {'56.168.192.in-addr.arpa': [
+        {'ptr': '21', 'name': '21.56.168.192.in-addr.arpa', 'ip': '192.168.56.21', 'host': 'node01.devops.local'},
+        {'ptr': '30', 'name': '30.56.168.192.in-addr.arpa', 'ip': '192.168.56.30', 'host': 'red.devops.local'}]}
+
+    {% for zone, records in hosts_to_ips | reverse_zones | dictsort %}
+    ; {{ zone }}
+    {%   for r in records %}
+    {{ r.ptr }}  IN  PTR  {{ r.host }}.
+    {%   endfor %}
+    {% endfor %}
+
+    '''
+
+    if ipv4_prefix not in (8, 16, 24) or ipv6_prefix % 4 or not 4 <= ipv6_prefix <= 124:
+        raise errors.AnsibleFilterError('reverse_zones() prefixes must fall on a label boundary')
+    if type(_data) == type([]):
+        items = [(None, i) for i in _data]
+    elif isinstance(_data, dict):
+        items = []
+        for host in sorted(_data):
+            if type(_data[host]) == type([]):
+                items.extend([(host, i) for i in _data[host]])
+            else:
+                items.append((host, _data[host]))
+    else:
+        raise errors.AnsibleFilterError('Unrecognized input arguments to reverse_zones()')
+
+    zones = {}
+    for host, ip in items:
+        ip = _to_text(ip)
+        try:
+            zone, ptr = _reverse_pointer(ip, ipv4_prefix=ipv4_prefix, ipv6_prefix=ipv6_prefix)
+        except (AddrFormatError, ValueError, TypeError, AttributeError) as e:
+            raise errors.AnsibleFilterError(
+                'reverse_zones() could not convert "{0}": {1}'.format(ip, str(e)))
+        zones.setdefault(zone, []).append({
+            'ip': ip,
+            'host': host,
+            'ptr': ptr,
+            'name': '{0}.{1}'.format(ptr, zone),
+        })
+    return zones
+
+
+def _zone_address_map(_hostvars, groups, zones):
+    '''
+    Return the address mappings for the members of one or more zones in a
+    single pass over inventory, for the dns role's mappings templates.
+
+    zones is a list of zone names, each of which is also the name of the
+    inventory group holding its members, or a dictionary mapping zone names
+    to group names. A host's address in a zone is
+    hostvars[host].net.iface[hostvars[host].zone_iface[zone]].ip. Each
+    host's variables are fetched (and templated by Ansible) only once, no
+    matter how many zones it is in.
+
+    For each zone the result holds 'defined' (whether the group exists),
+    'records' (a list of {'host': ..., 'ip': ...} in group order) and
+    'warnings' (one line for each host whose address could not be found).
+
+    hostvars | zone_address_map(groups, ['local'])
+    {'local': {'defined': True,
+               'records': [{'host': 'node01.devops.local', 'ip': '192.168.56.21'}],
+               'warnings': ["hostvars['red.devops.local'].net is not defined"]}}
+
+    '''
+
+    if isinstance(zones, dict):
+        pairs = sorted(zones.items())
+    elif type(zones) == type([]):
+        pairs = [(zone, zone) for zone in zones]
+    else:
+        raise errors.AnsibleFilterError('Unrecognized input arguments to zone_address_map()')
+
+    seen = {}
+    result = {}
+    for zone, group in pairs:
+        entry = {'defined': group in groups, 'records': [], 'warnings': []}
+        result[zone] = entry
+        if not entry['defined']:
+            entry['warnings'].append("groups['{0}'] is not defined".format(group))
+            continue
+        for host in groups[group]:
+            if host not in seen:
+                seen[host] = _hostvars[host]
+            hv = seen[host]
+            net = hv.get('net')
+            iface = (hv.get('zone_iface') or {}).get(zone)
+            if net is None:
+                entry['warnings'].append("hostvars['{0}'].net is not defined".format(host))
+            elif net.get('iface') is None:
+                entry['warnings'].append("hostvars['{0}'].net.iface is not defined".format(host))
+            elif iface is None:
+                entry['warnings'].append("hostvars['{0}'].zone_iface['{1}'] is not defined".format(host, zone))
+            elif (net['iface'].get(iface) or {}).get('ip') is None:
+                entry['warnings'].append(
+                    "hostvars['{0}'].net.iface[hostvars['{0}'].zone_iface['{1}']].ip is not defined".format(host, zone))
+            else:
+                entry['records'].append({'host': host, 'ip': net['iface'][iface]['ip']})
+    return result
+
+
+def _aggregate_cidrs(_list):
+    '''
+    Return the smallest list of CIDR blocks that covers exactly the IP
+    addresses and networks in the input list (IPv4 blocks first, then
+    IPv6, each in address order).
+
+    a = ['10.0.0.1', '10.0.0.0', '10.0.0.2/31', '192.168.56.0/24']
+    _aggregate_cidrs(a)
+    ['10.0.0.0/30', '192.168.56.0/24']
+
+    '''
+
+    if type(_list) == type([]):
+        try:
+            return [str(net) for net in cidr_merge([_to_text(i) for i in _list])]
+        except (AddrFormatError, ValueError, TypeError) as e:
+            raise errors.AnsibleFilterError(
+                'aggregate_cidrs() could not convert input: {0}'.format(str(e)))
+    else:
+        raise errors.AnsibleFilterError('Unrecognized input arguments to aggregate_cidrs()')
+
+
+def _ipset_restore(_list, name, family='inet', hashsize=1024, maxelem=65536):
+    '''
+    Return an "ipset restore" payload that (re)loads the hash:net set
+    named name with the aggregated CIDR blocks from the input list
+    (see _aggregate_cidrs()). The set is filled under a temporary name
+    and swapped into place, so rules matching it never see a partial set.
+    All entries must belong to family ('inet' or 'inet6'). maxelem must
+    be at least 1, and is doubled until it fits the number of entries.
+
+    a = ['10.0.0.1', '10.0.0.0', '192.168.56.0/24']
+    _ipset_restore(a, 'dims_peers')
+    create dims_peers hash:net family inet hashsize 1024 maxelem 65536 -exist
+    create dims_peers-tmp hash:net family inet hashsize 1024 maxelem 65536 -exist
+    flush dims_peers-tmp
+    add dims_peers-tmp 10.0.0.0/31
+    add dims_peers-tmp 192.168.56.0/24
+    swap dims_peers-tmp dims_peers
+    destroy dims_peers-tmp
+
+    '''
+
+    if family not in ('inet', 'inet6'):
+        raise errors.AnsibleFilterError('ipset_restore() family must be "inet" or "inet6"')
+    tmp = '{0}-tmp'.format(name)
+    if not name or len(tmp) > 31:
+        raise errors.AnsibleFilterError('ipset_restore() set name must be 1 to 27 characters')
+    try:
+        maxelem = int(maxelem)
+    except (TypeError, ValueError):
+        maxelem = 0
+    if maxelem < 1:
+        raise errors.AnsibleFilterError('ipset_restore() maxelem must be a positive integer')
+    nets = _aggregate_cidrs(_list)
+    version = 4 if family == 'inet' else 6
+    wrong = [net for net in nets if IPNetwork(net).version != version]
+    if wrong:
+        raise errors.AnsibleFilterError(
+            'ipset_restore() entries not in family {0}: {1}'.format(family, ', '.join(wrong)))
+    while maxelem < len(nets):
+        maxelem *= 2
+    create = 'hash:net family {0} hashsize {1} maxelem {2} -exist'.format(family, hashsize, maxelem)
+    lines = ['create {0} {1}'.format(name, create),
+             'create {0} {1}'.format(tmp, create),
+             'flush {0}'.format(tmp)]
+    lines.extend(['add {0} {1}'.format(tmp, net) for net in nets])
+    lines.extend(['swap {0} {1}'.format(tmp, name),
+                  'destroy {0}'.format(tmp)])
+    return '\n'.join(lines) + '\n'
+
+
+def _source_match(_list, name, threshold=8):
+    '''
+    Return the list of iptables source match arguments needed to match
+    the addresses and networks in the input list. Up to threshold
+    aggregated blocks are matched with one "-s" rule each; beyond that a
+    single match against the ipset named name is returned (load the set
+    with the payload from _ipset_restore() first).
+
+    {% for match in rabbitmq_peers | source_match('rabbitmq_peers') %}
+    -A INPUT {{ match }} -p tcp -m tcp --dport 5672 -j ACCEPT
+    {% endfor %}
+
+    '''
+
+    nets = _aggregate_cidrs(_list)
+    if len(nets) > threshold:
+        return ['-m set --match-set {0} src'.format(name)]
+    return ['-s {0}'.format(net) for net in nets]
+
+
+# Groups whose members form a quorum (e.g., Swarm managers, Consul servers,
+# RabbitMQ cluster nodes). Unless told otherwise, rolling_batches() keeps a
+# majority of the members of each of these groups up at all times.
+QUORUM_GROUPS = ['manager', 'consul', 'rabbitmq']
+
+
+def _host_weight(host, hostvars, weights, weight_by):
+    '''Return the relative capacity of a host for _rolling_batches()'''
+    if weights is not None and host in weights:
+        return max(float(weights[host]), 0.0)
+    if hostvars is None or weight_by == 'count':
+        return 1.0
+    try:
+        hv = hostvars[host]
+        if weight_by == 'memory':
+            return max(float(hv.get('ansible_memtotal_mb') or 1), 1.0)
+        return max(float(hv.get('ansible_processor_vcpus') or 1), 1.0)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return 1.0
+
+
+def _rolling_batches(_list, hostvars=None, groups=None, weights=None,
+                     weight_by='cpu', max_fraction=0.25, max_batch=None,
+                     quorum_groups=None, min_up=None, detail=False):
+    '''
+    Return a list of batch sizes for a play's "serial:" keyword that runs
+    as many of the hosts in _list (in the order the play will use them)
+    at once as is safe:
+
+    + each batch holds at most max_fraction of the total capacity, where a
+      host's capacity is weights[host] if given, else its CPU count (or,
+      with weight_by='memory', its memory) from gathered facts in
+      hostvars, else 1;
+    + each batch holds at most max_batch hosts (if given);
+    + no batch takes a quorum group (QUORUM_GROUPS, or quorum_groups) below
+      min_up[group] members, by default a majority of the group (a group
+      too small to lose any member and keep a majority still loses one
+      at a time). A min_up that leaves no member free to go down is an
+      error.
+
+    Every batch holds at least one host. Facts are only available when
+    they are cached; otherwise all hosts weigh the same. With detail=True
+    the host names in each batch are returned instead.
+
+    "serial:" is templated without groups or hostvars, so plan the batches
+    in an earlier play and read them back through hostvars:
+
+    - hosts: localhost
+      tasks:
+      - set_fact:
+          swarm_batches: "{{ groups.swarm | rolling_batches(hostvars=hostvars, groups=groups) }}"
+
+    - hosts: swarm
+      serial: "{{ hostvars['localhost'].swarm_batches }}"
+
+    a = ['node01', 'node02', 'node03', 'worker01', 'worker02', 'worker03', 'worker04']
+    _rolling_batches(a, groups={'manager': ['node01', 'node02', 'node03']}, max_fraction=0.5)
+    [1, 1, 3, 2]
+
+    '''
+
+    if type(_list) != type([]):
+        raise errors.AnsibleFilterError('Unrecognized input arguments to rolling_batches()')
+    if not _list:
+        return []
+    hosts = [_to_text(h) for h in _list]
+    groups = groups or {}
+    min_up = min_up or {}
+    if quorum_groups is None:
+        quorum_groups = QUORUM_GROUPS
+
+    # How many members of each quorum group may be down at the same time
+    members = {}
+    allowed = {}
+    for group in quorum_groups:
+        if group not in groups:
+            continue
+        group_hosts = set([_to_text(h) for h in groups[group]])
+        if group in min_up:
+            allowed[group] = len(group_hosts) - int(min_up[group])
+            if allowed[group] < 1 and group_hosts.intersection(hosts):
+                raise errors.AnsibleFilterError(
+                    'rolling_batches() min_up[{0}] = {1} leaves none of its {2} members free to go down'.format(
+                        group, min_up[group], len(group_hosts)))
+        else:
+            allowed[group] = max(len(group_hosts) - (len(group_hosts) // 2 + 1), 1)
+        for host in group_hosts:
+            members.setdefault(host, []).append(group)
+
+    weight = dict([(h, _host_weight(h, hostvars, weights, weight_by)) for h in hosts])
+    budget = sum(weight.values()) * float(max_fraction)
+
+    batches = []
+    batch = []
+    load = 0.0
+    down = {}
+    for host in hosts:
+        fits = (not batch or
+                (load + weight[host] <= budget and
+                 (max_batch is None or len(batch) < int(max_batch)) and
+                 all([down.get(g, 0) < allowed[g] for g in members.get(host, [])])))
+        if not fits:
+            batches.append(batch)
+            batch, load, down = [], 0.0, {}
+        batch.append(host)
+        load += weight[host]
+        for group in members.get(host, []):
+            down[group] = down.get(group, 0) + 1
+    batches.append(batch)
+
+    if detail:
+        return batches
+    return [len(b) for b in batches]
+
+
 def _lowercase(_str):
     '''Return the lowercase version of a string'''
     if isinstance(_str, basestring):
@@ -183,23 +872,90 @@ def _uppercase(_str):
         return "{}".format(_str).upper()
 
 
+# Setting DIMS_FILTER_STATS to a file name wraps every filter to count
+# calls, input sizes, latency and resolver cache hits. Each process adds
+# its numbers to the (locked) JSON file when it exits, so the file holds
+# the totals for all forks of a run (and of later runs, until removed).
+class _FilterStats(dims_plugin_utils.CallStats):
+    '''
+    Per-filter call statistics (see dims_plugin_utils.CallStats). Besides
+    the common fields, each filter's entry holds items (total input size)
+    and max_items, and its hits and misses are those of the resolver
+    cache during its calls.
+    '''
+
+    summed = dims_plugin_utils.CallStats.summed + ('items',)
+    maxed = ('max_items',)
+
+    def wrap(self, name, fn):
+        '''Return fn wrapped to record its calls under name'''
+        def _wrapped(*args, **kwargs):
+            cache = _resolver_cache
+            before = (cache.hits, cache.misses) if cache is not None else (0, 0)
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                cache = _resolver_cache
+                after = (cache.hits, cache.misses) if cache is not None else (0, 0)
+                if after < before:
+                    before = (0, 0)
+                size = 1
+                if args and hasattr(args[0], '__len__') and not isinstance(args[0], basestring):
+                    size = len(args[0])
+                self.record(name, elapsed, size, after[0] - before[0], after[1] - before[1])
+        _wrapped.__name__ = fn.__name__
+        _wrapped.__doc__ = fn.__doc__
+        return _wrapped
+
+    def record(self, name, elapsed, size, hits=0, misses=0):
+        entry = self.entry(name, elapsed)
+        entry['items'] += size
+        entry['max_items'] = max(entry['max_items'], size)
+        entry['hits'] += hits
+        entry['misses'] += misses
+
+
+_filter_stats = None
+
+
+def _get_filter_stats(path):
+    '''Return the _FilterStats collector for this process'''
+    global _filter_stats
+    if _filter_stats is None or _filter_stats.path != path:
+        _filter_stats = _FilterStats(path)
+    return _filter_stats
+
+
 class FilterModule(object):
     '''DIMS Ansible filters.'''
 
     def filters(self):
-        return {
+        filters = {
             # List filters
             'list_to_args': _list_to_args,
             'list_to_string_args': _list_to_string_args,
 
             # Docker/Consul/Swarm filters
             'names_to_ips': _names_to_ips,
+            'resolve_names': _resolve_names_filter,
             'initial_cluster': _initial_cluster,
             'initial_cluster_lookup_short': _initial_cluster_lookup_short,
             'add_domain': _add_domain,
 
+            # Deployment filters
+            'rolling_batches': _rolling_batches,
+
             # Networking filters
             'ip_to_in_addr_arpa': _ip_to_in_addr_arpa,
+            'reverse_zones': _reverse_zones,
+            'zone_address_map': _zone_address_map,
+
+            # Firewall filters
+            'aggregate_cidrs': _aggregate_cidrs,
+            'ipset_restore': _ipset_restore,
+            'source_match': _source_match,
 
             # String filters
             'lowercase': _lowercase,
@@ -207,3 +963,9 @@ class FilterModule(object):
 
             # Other filters go here...
         }
+
+        path = os.getenv('DIMS_FILTER_STATS')
+        if path:
+            stats = _get_filter_stats(path)
+            filters = dict([(name, stats.wrap(name, fn)) for name, fn in filters.items()])
+        return filters
@@ -9,16 +9,46 @@ Generates Ansible inventory of DigitalOcean Droplets.
 In addition to the --list and --host options used by Ansible, there are options
 for generating JSON of other DigitalOcean data.  This is useful when creating
 droplets.  For example, --regions will return all the DigitalOcean Regions.
-This information can also be easily found in the cache file, whose default
-location is /tmp/ansible-digital_ocean.cache).
+This information can also be easily found in the cache files, which are kept
+in the cache_path directory (one per resource, e.g.
+ansible-digital_ocean-regions.cache).
 
 The --pretty (-p) option pretty-prints the output for better human readability.
 
 ----
-Although the cache stores all the information received from DigitalOcean,
-the cache is not used for current droplet information (in --list, --host,
---all, and --droplets).  This is so that accurate droplet information is always
-found.  You can force this script to use the cache with --force-cache.
+The cache is split into a segment per resource (droplets, regions, images,
+sizes, ssh_keys and domains), and each one expires on its own.  Regions,
+sizes and images hardly ever change, so they can be kept for a long time,
+while droplets change all the time.  Segments are kept for cache_max_age
+seconds (INI file) or --cache-max_age, except droplets, which are fetched
+every time unless they are given a maximum age of their own.  Any
+resource can be given one with cache_max_age_RESOURCE (INI file) or
+--resource-max-age RESOURCE=SECONDS, e.g. in digital_ocean.ini:
+
+    [digital_ocean]
+    cache_path = /tmp
+    cache_max_age = 86400
+    cache_max_age_droplets = 60
+
+You can force this script to use the cache, however old, with --force-cache,
+or to fetch everything again with --refresh-cache.
+
+Segments are written as compact JSON (gzip compressed with cache_compress
+in the INI file or --cache-compress; either kind is read back) to a
+temporary file that is renamed into place under an advisory lock on
+ansible-digital_ocean.lock, so overlapping runs never read a partly written
+cache.  Whenever droplets are fetched, the --list output built from them is
+stored as well (ansible-digital_ocean-list.cache), and --list prints it
+as-is for as long as the droplets segment is valid.
+
+When the script is run with nothing but --list (as Ansible does) and the
+stored output is valid and was made with the same digital_ocean.ini, it is
+printed before the rest of the script, requests or dopy are even loaded.
+
+With track_changes (INI file) or --track-changes, droplets that are
+fetched are compared by ID with the cached ones, and the droplets that were
+added, removed or changed are kept in ansible-digital_ocean-changes.cache
+(not with --stream).  --changes prints them, e.g. for notifications.
 
 ----
 Configuration is read from `digital_ocean.ini`, then from environment variables,
@@ -31,11 +61,47 @@ in the INI file or with the following environment variables:
 
 Alternatively, it can be passed on the command-line with --api-token.
 
+The API is at https://api.digitalocean.com, unless api_endpoint (INI file)
+or DO_API_ENDPOINT points somewhere else, such as the stand-in server in
+benchmarks/fake_digital_ocean.py:
+    export DO_API_ENDPOINT='http://127.0.0.1:8801'
+
 If you specify DigitalOcean credentials in the INI file, a handy way to
 get them into your environment (e.g., to use the digital_ocean module)
 is to use the output of the --env option with export:
     export $(digital_ocean.py --env)
 
+----
+When more than one resource is needed (--all, or a cache refresh), the API
+requests are made at the same time, up to fetch_workers (INI file) or
+--fetch-workers of them. If any of them fails the script exits with an
+error, unless fetch_errors (INI file) or --fetch-errors is 'partial', in
+which case it carries on with what it has. Either way only the cache
+segments of the requests that succeeded are rewritten.
+
+Lists are fetched page_size (INI file) or --page-size items per request
+(default 200, the most the API returns per page).  Every run draws its
+requests from a token bucket shared through ansible-digital_ocean.bucket in
+the cache_path, which refills at api_rate requests a second (default 4, under
+the API's 250 a minute) up to api_burst (default 80).  When the API answers
+429, or says no requests are left, every run waits for its RateLimit-Reset
+time, unless that is more than api_max_wait seconds (default 60) away.  429
+and 5xx answers and connection errors are tried again up to api_retries
+times (default 5) after a jittered exponential backoff.
+
+If a resource still can't be fetched, stale_max_age (INI file) or
+--stale-max-age lets its expired cache segment be used instead, with a
+warning, as long as it is no older than that many seconds (default 0,
+never).
+
+----
+For accounts with many droplets, stream_droplets (INI file) or --stream
+builds --list a page of droplets at a time. Each page is added to the
+inventory groups, and its droplets are appended to the droplets cache
+segment and their variables to the stored --list output as they arrive.
+The output is then printed from there, so apart from the groups only a
+page of droplets is held in memory.
+
 ----
 The following groups are generated from --list:
  - ID    (droplet ID)
@@ -47,7 +113,13 @@ The following groups are generated from --list:
  - size_NAME
  - status_STATUS
 
-When run against a specific host, this script returns the following variables:
+The --list output carries these variables for every droplet in _meta
+hostvars, so Ansible has no need to run the script with --host.  When run
+against a specific host (a droplet name or ID), this script returns the
+same variables from the cached --list output while the droplets segment is
+valid.  Otherwise it only asks the API for that droplet, by ID, looking a
+name up in the cached output however old it is (all the droplets are only
+fetched for a name the cache doesn't know):
  - do_backup_ids
  - do_created_at
  - do_disk
@@ -73,11 +145,18 @@ When run against a specific host, this script returns the following variables:
 ```
 usage: digital_ocean.py [-h] [--list] [--host HOST] [--all]
                                  [--droplets] [--regions] [--images] [--sizes]
-                                 [--ssh-keys] [--domains] [--pretty]
+                                 [--ssh-keys] [--domains] [--changes]
+                                 [--pretty]
                                  [--cache-path CACHE_PATH]
                                  [--cache-max_age CACHE_MAX_AGE]
+                                 [--resource-max-age RESOURCE=SECONDS]
+                                 [--cache-compress] [--track-changes]
                                  [--force-cache]
                                  [--refresh-cache]
+                                 [--fetch-workers FETCH_WORKERS]
+                                 [--fetch-errors {fail,partial}]
+                                 [--stream] [--page-size PAGE_SIZE]
+                                 [--stale-max-age STALE_MAX_AGE]
                                  [--api-token API_TOKEN]
 
 Produce an Ansible Inventory file based on DigitalOcean credentials
@@ -95,14 +174,35 @@ optional arguments:
   --sizes               List Sizes as JSON
   --ssh-keys            List SSH keys as JSON
   --domains             List Domains as JSON
+  --changes             List the droplets added, removed and changed by the
+                        last refresh as JSON
   --pretty, -p          Pretty-print results
   --cache-path CACHE_PATH
                         Path to the cache files (default: .)
   --cache-max_age CACHE_MAX_AGE
                         Maximum age of the cached items (default: 0)
+  --resource-max-age RESOURCE=SECONDS
+                        Maximum age of the cached items of one resource (may
+                        be repeated)
+  --cache-compress      Write the cache files gzip compressed
+  --track-changes       Keep track of the droplets added, removed and changed
+                        by each refresh
   --force-cache         Only use data from the cache
   --refresh-cache       Force refresh of cache by making API requests to
                         DigitalOcean (default: False - use cache files)
+  --fetch-workers FETCH_WORKERS
+                        Number of API requests to make at once (default: 6)
+  --fetch-errors {fail,partial}
+                        When an API request fails, exit with an error (fail)
+                        or carry on with the resources that were fetched
+                        (partial) (default: fail)
+  --stream              Build --list from droplets a page at a time, writing
+                        the cache as they arrive
+  --page-size PAGE_SIZE
+                        Items per API request for lists (default: 200)
+  --stale-max-age STALE_MAX_AGE
+                        When the API fails, use cached items up to this old
+                        instead (default: 0, never)
   --api-token API_TOKEN, -a API_TOKEN
                         DigitalOcean API Token
 ```
@@ -133,25 +233,251 @@ optional arguments:
 
 import os
 import sys
-import re
-import argparse
-from time import time
-import ConfigParser
-import ast
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+
+def config_filename():
+    ''' The digital_ocean.ini file, next to this script '''
+    return os.path.dirname(os.path.realpath(__file__)) + '/digital_ocean.ini'
+
+
+def read_config_text():
+    ''' The text of digital_ocean.ini, or '' if there is none '''
+    try:
+        config = open(config_filename())
+        text = config.read()
+        config.close()
+    except IOError:
+        return ''
+    return text
+
+
+def print_cached_list():
+    ''' Prints the --list output stored in the cache and returns True, if
+    the script was run with nothing but --list and the output can be used
+    as it is.
+
+    Ansible runs the script like that on every invocation, so this is done
+    before requests and dopy are imported. The stored output is only used
+    if it was made with exactly the same digital_ocean.ini (kept with it,
+    see inventory_settings()), which is read with ConfigParser the same way
+    read_settings() does to find cache_path. '''
+    if sys.argv[1:] not in ([], ['--list']):
+        return False
+    import ConfigParser
+    import zlib
+    from time import time
+
+    config = read_config_text()
+    parser = ConfigParser.SafeConfigParser()
+    try:
+        parser.read(config_filename())
+        cache_path = '.'
+        if parser.has_option('digital_ocean', 'cache_path'):
+            cache_path = parser.get('digital_ocean', 'cache_path')
+    except ConfigParser.Error:
+        return False
+
+    try:
+        cache = open(os.path.join(cache_path, 'ansible-digital_ocean-list.cache'), 'rb')
+        try:
+            data = cache.read()
+        finally:
+            cache.close()
+        if data.startswith('\x1f\x8b'):
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        settings, _, inventory = data.partition('\n')
+        settings = json.loads(settings)
+        if settings['config'] != config:
+            return False
+        mod_time = os.path.getmtime(os.path.join(cache_path, 'ansible-digital_ocean-droplets.cache'))
+        if mod_time + settings['max_age'] <= time():
+            return False
+    except (IOError, OSError, ValueError, TypeError, KeyError, zlib.error):
+        return False
+    sys.stdout.write(inventory + '\n')
+    return True
+
+
+if print_cached_list():
+    sys.exit(0)
+
+
+import re
+import argparse
+import fcntl
+import gzip
+import random
+import zlib
+from time import time, sleep
+from multiprocessing.pool import ThreadPool
+import ConfigParser
+import ast
+
 try:
-    from dopy.manager import DoManager
+    import requests
+    from dopy.manager import DoManager, DoError
 except ImportError as e:
     print("failed=True msg='`dopy` library required for this script'")
     sys.exit(1)
 
 
 
+class CacheWriter(object):
+    '''Writes a cache segment, optionally gzip compressed.
+
+    The segment is written under a temporary name and only renamed into
+    place by commit(), so readers never see a partly written cache.'''
+
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        self.file = open(self.tmp_filename, 'wb')
+        if compress:
+            self.stream = gzip.GzipFile(filename='', mode='wb', fileobj=self.file)
+        else:
+            self.stream = self.file
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self):
+        if self.stream is not self.file:
+            self.stream.close()
+        self.file.close()
+
+    def commit(self):
+        os.rename(self.tmp_filename, self.filename)
+
+    def abort(self):
+        self.close()
+        os.unlink(self.tmp_filename)
+
+
+class ApiClient(object):
+    '''Gets resources from the DigitalOcean v2 API for the inventory.
+
+    Every run of the script draws its requests from one token bucket, kept
+    in a file under an fcntl lock, that refills at rate requests a second
+    up to burst. When the API says the rate limit is used up (a 429, or
+    RateLimit-Remaining 0) the bucket stays empty until RateLimit-Reset.
+    Waits longer than max_wait fail instead. 429 and 5xx answers and
+    connection errors are tried again up to retries times, after a
+    jittered exponential backoff.'''
+
+    def __init__(self, endpoint, token, bucket_filename, page_size=200, rate=4.0,
+                 burst=80, retries=5, backoff=0.5, max_wait=60):
+        self.endpoint = endpoint
+        self.headers = {'Authorization': 'Bearer %s' % token,
+                        'Content-Type': 'application/json'}
+        self.bucket_filename = bucket_filename
+        self.page_size = page_size
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+
+    def bucket(self, update):
+        '''Call update(state, now) on the bucket with the bucket file locked,
+        and save the state if it returns None. Returns what update returned.'''
+        bucket = open(self.bucket_filename, 'a+')
+        try:
+            fcntl.flock(bucket, fcntl.LOCK_EX)
+            bucket.seek(0)
+            now = time()
+            try:
+                state = json.loads(bucket.read())
+            except ValueError:
+                state = {'tokens': self.burst, 'time': now, 'until': 0}
+            result = update(state, now)
+            if result is None:
+                bucket.seek(0)
+                bucket.truncate()
+                bucket.write(json.dumps(state))
+            return result
+        finally:
+            bucket.close()
+
+    def take(self):
+        '''Wait for a request from the bucket'''
+        def update(state, now):
+            if now < state['until']:
+                return state['until'] - now
+            tokens = min(self.burst, state['tokens'] + (now - state['time']) * self.rate)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            state['tokens'] = tokens - 1
+            state['time'] = now
+
+        while True:
+            wait = self.bucket(update)
+            if wait is None:
+                return
+            if wait > self.max_wait:
+                raise DoError('the API rate limit holds requests back for %d seconds' % wait)
+            sleep(wait)
+
+    def hold(self, until):
+        '''Make no more requests (from any run) until the given time'''
+        def update(state, now):
+            state['until'] = max(state['until'], until)
+            state['tokens'] = 0
+            state['time'] = now
+        self.bucket(update)
+
+    def get(self, url):
+        '''GET a URL, or a path under the endpoint, and return the JSON answer'''
+        if '://' not in url:
+            url = '%s/%s' % (self.endpoint, url)
+        attempt = 0
+        while True:
+            self.take()
+            try:
+                resp = requests.get(url, headers=self.headers, timeout=60)
+            except requests.RequestException as e:
+                error, retry = RuntimeError(e), True
+            else:
+                reset = resp.headers.get('RateLimit-Reset', '')
+                if reset.isdigit() and (resp.status_code == 429 or
+                                        resp.headers.get('RateLimit-Remaining') == '0'):
+                    self.hold(int(reset))
+                if resp.status_code == requests.codes.ok:
+                    try:
+                        return resp.json()
+                    except ValueError:
+                        raise ValueError("The API server doesn't respond with a valid json")
+                try:
+                    message = resp.json()['message']
+                except (ValueError, KeyError, TypeError):
+                    message = 'HTTP %d' % resp.status_code
+                error, retry = DoError(message), resp.status_code == 429 or resp.status_code >= 500
+                error.status_code = resp.status_code
+            if not retry or attempt >= self.retries:
+                raise error
+            sleep(random.uniform(0, min(self.backoff * 2 ** attempt, 30)))
+            attempt += 1
+
+    def pages(self, path, key):
+        '''Yield the items of a list resource a page at a time'''
+        url = '%s?page=1&per_page=%d' % (path, self.page_size)
+        while url:
+            page = self.get(url)
+            yield page.get(key, [])
+            url = page.get('links', {}).get('pages', {}).get('next')
+
+    def all(self, path, key):
+        '''Return all the items of a list resource'''
+        items = []
+        for page in self.pages(path, key):
+            items.extend(page)
+        return items
+
+
 class DigitalOceanInventory(object):
 
     ###########################################################################
@@ -164,12 +490,28 @@ class DigitalOceanInventory(object):
         # DigitalOceanInventory data
         self.data = {}      # All DigitalOcean data
         self.inventory = {} # Ansible Inventory
+        self.inventory_json = None
+        self.changes = None # Droplets added, removed and changed by this run
+        self.streamed_list = None # The --list output written by stream_inventory()
 
         # Define defaults
         self.cache_path = '.'
         self.cache_max_age = 0
+        self.cache_max_ages = {}
+        self.cache_compress = False
+        self.track_changes = False
+        self.api_endpoint = None
+        self.api_rate = 4.0
+        self.api_burst = 80
+        self.api_retries = 5
+        self.api_max_wait = 60
+        self.stale_max_age = 0
         self.use_private_network = False
         self.group_variables = {}
+        self.fetch_workers = 6
+        self.fetch_errors = 'fail'
+        self.stream_droplets = False
+        self.page_size = 200
 
         # Read settings, environment variables, and CLI arguments
         self.read_settings()
@@ -189,17 +531,16 @@ or environment variables (DO_API_TOKEN)''')
             sys.exit(0)
 
         # Manage cache
-        self.cache_filename = self.cache_path + "/ansible-digital_ocean.cache"
-        self.cache_refreshed = False
-
-        if self.is_cache_valid:
-            self.load_from_cache()
-            if len(self.data) == 0:
-                if self.args.force_cache:
-                    print('''Cache is empty and --force-cache was specified''')
-                    sys.exit(-1)
+        self.cache_refreshed = set()
+        self.cache_writers = []
 
         self.manager = DoManager(None, self.api_token, api_version=2)
+        if self.api_endpoint:
+            self.manager.api_endpoint = self.api_endpoint.rstrip('/') + '/v2'
+        self.client = ApiClient(self.manager.api_endpoint, self.api_token,
+                                os.path.join(self.cache_path, 'ansible-digital_ocean.bucket'),
+                                page_size=self.page_size, rate=self.api_rate, burst=self.api_burst,
+                                retries=self.api_retries, max_wait=self.api_max_wait)
 
         # Pick the json_data to print based on the CLI command
         if self.args.droplets:
@@ -225,16 +566,31 @@ or environment variables (DO_API_TOKEN)''')
             json_data = self.data
         elif self.args.host:
             json_data = self.load_droplet_variables_for_host()
+        elif self.args.changes:
+            json_data = json.loads(self.read_cache('changes') or '{}')
+        elif self.load_inventory_from_cache():    # '--list'
+            json_data = self.inventory
+        elif (self.stream_droplets and not self.args.force_cache and
+                (self.args.refresh_cache or not self.is_cache_valid('droplets'))):    # '--list'
+            self.stream_inventory()
+            json_data = self.inventory
         else:    # '--list' this is last to make it default
             self.load_from_digital_ocean('droplets')
             self.build_inventory()
+            self.cache_refreshed.add('list')
             json_data = self.inventory
 
+        if self.track_changes and 'droplets' in self.cache_refreshed and 'droplets' in self.data:
+            self.find_changes()
         if self.cache_refreshed:
             self.write_to_cache()
 
-        if self.args.pretty:
+        if json_data is self.inventory and self.streamed_list is not None:
+            self.print_streamed_list()
+        elif self.args.pretty:
             print(json.dumps(json_data, sort_keys=True, indent=2))
+        elif json_data is self.inventory and self.inventory_json:
+            print(self.inventory_json)
         else:
             print(json.dumps(json_data))
         # That's all she wrote...
@@ -247,17 +603,29 @@ or environment variables (DO_API_TOKEN)''')
     def read_settings(self):
         ''' Reads the settings from the digital_ocean.ini file '''
         config = ConfigParser.SafeConfigParser()
-        config.read(os.path.dirname(os.path.realpath(__file__)) + '/digital_ocean.ini')
+        config.read(config_filename())
+        self.config_text = read_config_text()
 
         # Credentials
         if config.has_option('digital_ocean', 'api_token'):
             self.api_token = config.get('digital_ocean', 'api_token')
+        if config.has_option('digital_ocean', 'api_endpoint'):
+            self.api_endpoint = config.get('digital_ocean', 'api_endpoint')
 
         # Cache related
         if config.has_option('digital_ocean', 'cache_path'):
             self.cache_path = config.get('digital_ocean', 'cache_path')
         if config.has_option('digital_ocean', 'cache_max_age'):
             self.cache_max_age = config.getint('digital_ocean', 'cache_max_age')
+        for resource in self.resources:
+            if config.has_option('digital_ocean', 'cache_max_age_' + resource):
+                self.cache_max_ages[resource] = config.getint('digital_ocean', 'cache_max_age_' + resource)
+        # How long the --list output is good for with no CLI arguments
+        self.config_list_max_age = self.resource_max_age('droplets')
+        if config.has_option('digital_ocean', 'cache_compress'):
+            self.cache_compress = config.getboolean('digital_ocean', 'cache_compress')
+        if config.has_option('digital_ocean', 'track_changes'):
+            self.track_changes = config.getboolean('digital_ocean', 'track_changes')
 
         # Private IP Address
         if config.has_option('digital_ocean', 'use_private_network'):
@@ -267,6 +635,26 @@ or environment variables (DO_API_TOKEN)''')
         if config.has_option('digital_ocean', 'group_variables'):
             self.group_variables = ast.literal_eval(config.get('digital_ocean', 'group_variables'))
 
+        # API requests
+        if config.has_option('digital_ocean', 'fetch_workers'):
+            self.fetch_workers = config.getint('digital_ocean', 'fetch_workers')
+        if config.has_option('digital_ocean', 'fetch_errors'):
+            self.fetch_errors = config.get('digital_ocean', 'fetch_errors')
+        if config.has_option('digital_ocean', 'stream_droplets'):
+            self.stream_droplets = config.getboolean('digital_ocean', 'stream_droplets')
+        if config.has_option('digital_ocean', 'page_size'):
+            self.page_size = config.getint('digital_ocean', 'page_size')
+        if config.has_option('digital_ocean', 'api_rate'):
+            self.api_rate = config.getfloat('digital_ocean', 'api_rate')
+        if config.has_option('digital_ocean', 'api_burst'):
+            self.api_burst = config.getint('digital_ocean', 'api_burst')
+        if config.has_option('digital_ocean', 'api_retries'):
+            self.api_retries = config.getint('digital_ocean', 'api_retries')
+        if config.has_option('digital_ocean', 'api_max_wait'):
+            self.api_max_wait = config.getint('digital_ocean', 'api_max_wait')
+        if config.has_option('digital_ocean', 'stale_max_age'):
+            self.stale_max_age = config.getint('digital_ocean', 'stale_max_age')
+
     def read_environment(self):
         ''' Reads the settings from environment variables '''
         # Setup credentials
@@ -274,6 +662,8 @@ or environment variables (DO_API_TOKEN)''')
             self.api_token = os.getenv("DO_API_TOKEN")
         if os.getenv("DO_API_KEY"):
             self.api_token = os.getenv("DO_API_KEY")
+        if os.getenv("DO_API_ENDPOINT"):
+            self.api_endpoint = os.getenv("DO_API_ENDPOINT")
 
 
     def read_cli_args(self):
@@ -290,15 +680,35 @@ or environment variables (DO_API_TOKEN)''')
         parser.add_argument('--sizes', action='store_true', help='List Sizes as JSON')
         parser.add_argument('--ssh-keys', action='store_true', help='List SSH keys as JSON')
         parser.add_argument('--domains', action='store_true',help='List Domains as JSON')
+        parser.add_argument('--changes', action='store_true',
+                            help='List the droplets added, removed and changed by the last refresh as JSON')
 
         parser.add_argument('--pretty','-p', action='store_true', help='Pretty-print results')
 
         parser.add_argument('--cache-path', action='store', help='Path to the cache files (default: .)')
-        parser.add_argument('--cache-max_age', action='store', help='Maximum age of the cached items (default: 0)')
+        parser.add_argument('--cache-max_age', action='store', type=int, help='Maximum age of the cached items (default: 0)')
+        parser.add_argument('--resource-max-age', action='append', metavar='RESOURCE=SECONDS',
+                            help='Maximum age of the cached items of one resource (may be repeated)')
+        parser.add_argument('--cache-compress', action='store_true', default=False,
+                            help='Write the cache files gzip compressed')
+        parser.add_argument('--track-changes', action='store_true', default=False,
+                            help='Keep track of the droplets added, removed and changed by each refresh')
         parser.add_argument('--force-cache', action='store_true', default=False, help='Only use data from the cache')
         parser.add_argument('--refresh-cache','-r', action='store_true', default=False,
                             help='Force refresh of cache by making API requests to DigitalOcean (default: False - use cache files)')
 
+        parser.add_argument('--fetch-workers', action='store', type=int,
+                            help='Number of API requests to make at once (default: 6)')
+        parser.add_argument('--fetch-errors', action='store', choices=['fail', 'partial'],
+                            help='When an API request fails, exit with an error (fail) or carry on with the resources that were fetched (partial) (default: fail)')
+
+        parser.add_argument('--stream', action='store_true', default=False,
+                            help='Build --list from droplets a page at a time, writing the cache as they arrive')
+        parser.add_argument('--page-size', action='store', type=int,
+                            help='Items per API request for lists (default: 200)')
+        parser.add_argument('--stale-max-age', action='store', type=int,
+                            help='When the API fails, use cached items up to this old instead (default: 0, never)')
+
         parser.add_argument('--env','-e', action='store_true', help='Display DO_API_TOKEN')
         parser.add_argument('--api-token','-a', action='store', help='DigitalOcean API Token')
 
@@ -306,12 +716,37 @@ or environment variables (DO_API_TOKEN)''')
 
         if self.args.api_token:
             self.api_token = self.args.api_token
+        if self.args.cache_path:
+            self.cache_path = self.args.cache_path
+        if self.args.cache_max_age is not None:
+            self.cache_max_age = self.args.cache_max_age
+        for option in self.args.resource_max_age or []:
+            resource, _, seconds = option.partition('=')
+            if resource not in self.resources or not seconds.isdigit():
+                parser.error('--resource-max-age expects RESOURCE=SECONDS, with RESOURCE one of %s' %
+                             ', '.join(self.resources))
+            self.cache_max_ages[resource] = int(seconds)
+        if self.args.cache_compress:
+            self.cache_compress = True
+        if self.args.track_changes:
+            self.track_changes = True
+        if self.args.fetch_workers:
+            self.fetch_workers = self.args.fetch_workers
+        if self.args.fetch_errors:
+            self.fetch_errors = self.args.fetch_errors
+        if self.args.stream:
+            self.stream_droplets = True
+        if self.args.page_size:
+            self.page_size = self.args.page_size
+        if self.args.stale_max_age is not None:
+            self.stale_max_age = self.args.stale_max_age
 
         # Make --list default if none of the other commands are specified
         if (not self.args.droplets and not self.args.regions and
                 not self.args.images and not self.args.sizes and
                 not self.args.ssh_keys and not self.args.domains and
-                not self.args.all and not self.args.host):
+                not self.args.all and not self.args.host and
+                not self.args.changes):
             self.args.list = True
 
 
@@ -320,37 +755,121 @@ or environment variables (DO_API_TOKEN)''')
     ###########################################################################
 
     def load_from_digital_ocean(self, resource=None):
-        '''Get JSON from DigitalOcean API'''
+        '''Get JSON from DigitalOcean API, or from the cache where it is recent enough'''
+        if self.args.refresh_cache:
+            resource=None
+        self.load_resources([resource] if resource is not None else self.resources)
+
+
+    def load_resources(self, resources):
+        '''Load resources from their cache segments, fetching the ones
+        that have expired (or all of them, with --refresh-cache)'''
         if self.args.force_cache:
+            for resource in resources:
+                self.load_from_cache(resource)
+                if resource not in self.data:
+                    print('''Cache has no %s and --force-cache was specified''' % resource)
+                    sys.exit(-1)
             return
-        # We always get fresh droplets
-        if self.is_cache_valid() and not (resource=='droplets' or resource is None):
+
+        stale = []
+        for resource in resources:
+            if not self.args.refresh_cache and self.is_cache_valid(resource):
+                self.load_from_cache(resource)
+            if resource not in self.data:
+                stale.append(resource)
+        if not stale:
             return
-        if self.args.refresh_cache:
-            resource=None
 
-        if resource == 'droplets' or resource is None:
-            self.data['droplets'] = self.manager.all_active_droplets()
-            self.cache_refreshed = True
-        if resource == 'regions' or resource is None:
-            self.data['regions'] = self.manager.all_regions()
-            self.cache_refreshed = True
-        if resource == 'images' or resource is None:
-            self.data['images'] = self.manager.all_images(filter=None)
-            self.cache_refreshed = True
-        if resource == 'sizes' or resource is None:
-            self.data['sizes'] = self.manager.sizes()
-            self.cache_refreshed = True
-        if resource == 'ssh_keys' or resource is None:
-            self.data['ssh_keys'] = self.manager.all_ssh_keys()
-            self.cache_refreshed = True
-        if resource == 'domains' or resource is None:
-            self.data['domains'] = self.manager.all_domains()
-            self.cache_refreshed = True
+        results, errors = self.fetch_resources(stale)
+        self.data.update(results)
+        self.cache_refreshed.update(results)
+
+        for name in sorted(errors):
+            if self.load_stale_from_cache(name, errors[name]):
+                del errors[name]
+            else:
+                sys.stderr.write('Could not get %s from DigitalOcean: %s\n' % (name, errors[name]))
+        if errors:
+            if self.fetch_errors != 'partial' or ('droplets' in errors and 'droplets' not in self.data):
+                sys.exit(-1)
+
+
+    def load_stale_from_cache(self, resource, error):
+        '''Fall back on an expired cache segment, if it is no older than
+        stale_max_age, when a resource could not be fetched'''
+        filename = self.cache_filename(resource)
+        if self.stale_max_age <= 0 or not os.path.isfile(filename):
+            return False
+        age = time() - os.path.getmtime(filename)
+        if age > self.stale_max_age:
+            return False
+        self.load_from_cache(resource)
+        if resource not in self.data:
+            return False
+        sys.stderr.write('Could not get %s from DigitalOcean, using the cache from %d seconds ago: %s\n' %
+                         (resource, age, error))
+        return True
+
+
+    # The resources fetched for --all, and how to get each of them
+    resources = ['droplets', 'regions', 'images', 'sizes', 'ssh_keys', 'domains']
+
+    def fetch_resource(self, resource):
+        '''Get one resource from the DigitalOcean API'''
+        if resource == 'droplets':
+            droplets = self.client.all('droplets/', 'droplets')
+            for droplet in droplets:
+                self.manager.populate_droplet_ips(droplet)
+            return droplets
+        if resource == 'regions':
+            return self.client.all('regions/', 'regions')
+        if resource == 'images':
+            return self.client.all('images/', 'images')
+        if resource == 'sizes':
+            return self.client.all('sizes/', 'sizes')
+        if resource == 'ssh_keys':
+            return self.client.all('account/keys', 'ssh_keys')
+        if resource == 'domains':
+            return self.client.all('domains/', 'domains')
+        raise ValueError('unknown resource %s' % resource)
+
+
+    def fetch_resources(self, resources):
+        '''Get resources from the DigitalOcean API at the same time.
+        Returns a dict of the results and a dict of the errors, by resource.'''
+        def fetch(resource):
+            try:
+                return resource, self.fetch_resource(resource), None
+            except Exception as e:
+                return resource, None, e
+
+        if len(resources) == 1 or self.fetch_workers <= 1:
+            outcomes = [fetch(resource) for resource in resources]
+        else:
+            pool = ThreadPool(min(self.fetch_workers, len(resources)))
+            try:
+                outcomes = pool.map(fetch, resources)
+            finally:
+                pool.close()
+                pool.join()
+
+        results = dict([(r, value) for r, value, error in outcomes if error is None])
+        errors = dict([(r, error) for r, value, error in outcomes if error is not None])
+        return results, errors
 
 
     def build_inventory(self):
         '''Build Ansible inventory of droplets'''
+        self.start_inventory()
+
+        # add all droplets by id and name
+        for droplet in self.data['droplets']:
+            self.add_droplet_to_inventory(droplet)
+
+
+    def start_inventory(self):
+        '''Start an Ansible inventory with no droplets in it'''
         self.inventory = {
                             'all': {
                                     'hosts': [],
@@ -359,63 +878,197 @@ or environment variables (DO_API_TOKEN)''')
                             '_meta': {'hostvars': {}}
                         }
 
-        # add all droplets by id and name
-        for droplet in self.data['droplets']:
-            #when using private_networking, the API reports the private one in "ip_address".
-            if 'private_networking' in droplet['features'] and not self.use_private_network:
-                for net in droplet['networks']['v4']:
-                    if net['type']=='public':
-                        dest_ip=net['ip_address']
-                        dest=droplet['name']
-                    else:
-                        continue
-            else:
-                dest_ip = droplet['ip_address']
-                dest = droplet['name']
 
-            self.inventory['all']['hosts'].append(dest)
+    def add_droplet_to_inventory(self, droplet, hostvars=True):
+        '''Add a droplet to the hosts and groups of the inventory (and its
+        variables to the _meta hostvars, with hostvars) and return its host
+        name'''
+        #when using private_networking, the API reports the private one in "ip_address".
+        if 'private_networking' in droplet['features'] and not self.use_private_network:
+            for net in droplet['networks']['v4']:
+                if net['type']=='public':
+                    dest_ip=net['ip_address']
+                    dest=droplet['name']
+                else:
+                    continue
+        else:
+            dest_ip = droplet['ip_address']
+            dest = droplet['name']
+
+        self.inventory['all']['hosts'].append(dest)
+        if hostvars:
+            self.inventory['_meta']['hostvars'][dest] = self.droplet_variables(droplet)
+
+        self.inventory[droplet['id']] = [dest]
+        self.inventory[droplet['ip_address']] = [dest]
+
+        # groups that are always present
+        for group in [
+                        'region_' + droplet['region']['slug'],
+                        'image_' + str(droplet['image']['id']),
+                        'size_' + droplet['size']['slug'],
+                        'distro_' + self.to_safe(droplet['image']['distribution']),
+                        'status_' + droplet['status'],
+
+                    ]:
+            if group not in self.inventory:
+                self.inventory[group] = { 'hosts': [ ], 'vars': {} }
+            self.inventory[group]['hosts'].append(dest)
+
+        # groups that are not always present
+        for group in [
+                        droplet['image']['slug'],
+                        droplet['image']['name']
+                     ]:
+            if group:
+                image = 'image_' + self.to_safe(group)
+                if image not in self.inventory:
+                    self.inventory[image] = { 'hosts': [ ], 'vars': {} }
+                self.inventory[image]['hosts'].append(dest)
+
+        return dest
+
+
+    def stream_inventory(self):
+        '''Build the --list inventory from droplets a page at a time.
+
+        Each page is added to the groups of the inventory, and written to the
+        droplets cache segment and (as _meta hostvars) to the --list segment
+        as it arrives, and is then dropped, so only one page of droplets is
+        held in memory at once: self.data['droplets'] is not set and the
+        inventory has no hostvars. The output is printed from the --list
+        segment by print_streamed_list().'''
+        if self.args.refresh_cache:
+            self.load_resources([r for r in self.resources if r != 'droplets'])
 
-            self.inventory[droplet['id']] = [dest]
-            self.inventory[droplet['ip_address']] = [dest]
+        self.start_inventory()
+        del self.inventory['_meta']
+        writers = []
+        try:
+            droplets_writer = CacheWriter(self.cache_filename('droplets'), self.cache_compress)
+            writers.append(droplets_writer)
+            list_writer = CacheWriter(self.cache_filename('list'), self.cache_compress)
+            writers.append(list_writer)
+            list_writer.write(self.inventory_settings() + '\n{"_meta":{"hostvars":{')
+            separator = ''
+            for droplets in self.iter_droplet_pages():
+                for droplet in droplets:
+                    dest = self.add_droplet_to_inventory(droplet, hostvars=False)
+                    droplets_writer.write((separator or '[') + json.dumps(droplet, separators=(',', ':')))
+                    list_writer.write(separator + json.dumps(dest) + ':' +
+                                      json.dumps(self.droplet_variables(droplet), separators=(',', ':')))
+                    separator = ','
+            droplets_writer.write(']' if separator else '[]')
+            # The groups follow the hostvars in the same object
+            list_writer.write('}},' + json.dumps(self.inventory, separators=(',', ':'))[1:])
+            for writer in writers:
+                writer.close()
+            # Kept open to print from, whatever happens to the file
+            self.streamed_list = open(list_writer.tmp_filename, 'rb')
+        except Exception as e:
+            for writer in writers:
+                writer.abort()
+            if self.load_stale_from_cache('droplets', e):
+                self.build_inventory()
+                return
+            sys.stderr.write('Could not get droplets from DigitalOcean: %s\n' % e)
+            sys.exit(-1)
 
-            # groups that are always present
-            for group in [
-                            'region_' + droplet['region']['slug'],
-                            'image_' + str(droplet['image']['id']),
-                            'size_' + droplet['size']['slug'],
-                            'distro_' + self.to_safe(droplet['image']['distribution']),
-                            'status_' + droplet['status'],
+        self.cache_writers.extend(writers)
+        self.cache_refreshed.add('droplets')
 
-                        ]:
-                if group not in self.inventory:
-                    self.inventory[group] = { 'hosts': [ ], 'vars': {} }
-                self.inventory[group]['hosts'].append(dest)
 
-            # groups that are not always present
-            for group in [
-                            droplet['image']['slug'],
-                            droplet['image']['name']
-                         ]:
-                if group:
-                    image = 'image_' + self.to_safe(group)
-                    if image not in self.inventory:
-                        self.inventory[image] = { 'hosts': [ ], 'vars': {} }
-                    self.inventory[image]['hosts'].append(dest)
+    def print_streamed_list(self):
+        '''Print the --list output written by stream_inventory() a chunk at
+        a time (or all at once to pretty-print it)'''
+        stream = self.streamed_list
+        if self.cache_compress:
+            stream = gzip.GzipFile(filename='', mode='rb', fileobj=stream)
+        stream.readline()
+        if self.args.pretty:
+            print(json.dumps(json.loads(stream.read()), sort_keys=True, indent=2))
+            return
+        while True:
+            chunk = stream.read(65536)
+            if not chunk:
+                break
+            sys.stdout.write(chunk)
+        sys.stdout.write('\n')
 
 
+    def iter_droplet_pages(self):
+        '''Yield the active droplets from the DigitalOcean API a page at a time'''
+        for droplets in self.client.pages('droplets/', 'droplets'):
+            for droplet in droplets:
+                self.manager.populate_droplet_ips(droplet)
+            yield droplets
 
-    def load_droplet_variables_for_host(self):
-        '''Generate a JSON response to a --host call'''
-        host = int(self.args.host)
 
-        droplet = self.manager.show_droplet(host)
 
-        # Put all the information in a 'do_' namespace
+    def load_droplet_variables_for_host(self):
+        '''Generate a JSON response to a --host call: the variables of a
+        droplet (by name or ID), the same as its _meta hostvars in --list.
+        They are looked up in the cached --list inventory while that is
+        valid. Otherwise only the droplet itself is fetched, by ID, a name
+        being looked up in the cached inventory however old it is; all the
+        droplets are only fetched for a name the cache doesn't know.'''
+        host = self.args.host
+
+        if self.load_inventory_from_cache():
+            info = self.find_host_variables(host)
+            if info is not None:
+                return info
+
+        if not self.args.force_cache:
+            if host.isdigit():
+                try:
+                    return self.droplet_variables(self.fetch_droplet(host))
+                except DoError as e:
+                    if getattr(e, 'status_code', None) != 404:
+                        raise
+                    return {}
+            if self.load_inventory_from_cache(expired=True):
+                info = self.find_host_variables(host)
+                if info is not None:
+                    try:
+                        droplet = self.fetch_droplet(info['do_id'])
+                    except DoError:
+                        droplet = None # Gone since the cache was written
+                    if droplet is not None and droplet['name'] == host:
+                        return self.droplet_variables(droplet)
+
+        self.load_from_digital_ocean('droplets')
+        self.build_inventory()
+        info = self.find_host_variables(host)
+        if info is None:
+            return {}
+        return info
+
+
+    def fetch_droplet(self, droplet_id):
+        '''Get one droplet from the DigitalOcean API by ID'''
+        droplet = self.client.get('droplets/%d' % int(droplet_id))['droplet']
+        self.manager.populate_droplet_ips(droplet)
+        return droplet
+
+
+    def find_host_variables(self, host):
+        '''Return the hostvars of a droplet in the inventory by name or ID'''
+        hostvars = self.inventory['_meta']['hostvars']
+        if host in hostvars:
+            return hostvars[host]
+        for info in hostvars.values():
+            if str(info.get('do_id')) == host:
+                return info
+        return None
+
+
+    def droplet_variables(self, droplet):
+        '''Put all the information about a droplet in a 'do_' namespace'''
         info = {}
         for k, v in droplet.items():
             info['do_'+k] = v
-
-        return {'droplet': info}
+        return info
 
 
 
@@ -423,38 +1076,179 @@ or environment variables (DO_API_TOKEN)''')
     # Cache Management
     ###########################################################################
 
-    def is_cache_valid(self):
-        ''' Determines if the cache files have expired, or if it is still valid '''
-        if os.path.isfile(self.cache_filename):
-            mod_time = os.path.getmtime(self.cache_filename)
+    def cache_filename(self, resource):
+        ''' The cache segment of a resource '''
+        return os.path.join(self.cache_path, 'ansible-digital_ocean-%s.cache' % resource)
+
+
+    def resource_max_age(self, resource):
+        ''' How long the cached items of a resource are good for. Droplets
+        change too often to share cache_max_age with the others, so they are
+        always fetched unless they are given a maximum age of their own. '''
+        if resource in self.cache_max_ages:
+            return self.cache_max_ages[resource]
+        if resource == 'droplets':
+            return 0
+        return self.cache_max_age
+
+
+    def is_cache_valid(self, resource):
+        ''' Determines if the cache segment of a resource has expired, or if it is still valid '''
+        filename = self.cache_filename(resource)
+        if os.path.isfile(filename):
+            mod_time = os.path.getmtime(filename)
             current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
+            if (mod_time + self.resource_max_age(resource)) > current_time:
                 return True
         return False
 
 
-    def load_from_cache(self):
-        ''' Reads the data from the cache file and assigns it to member variables as Python Objects'''
+    def cache_lock(self, operation):
+        ''' Takes the advisory lock on the cache (fcntl.LOCK_SH to read
+        segments that belong together, fcntl.LOCK_EX to replace them) and
+        returns the lock file, or None if it can't be opened. Closing the
+        file releases the lock. '''
+        try:
+            lock = open(os.path.join(self.cache_path, 'ansible-digital_ocean.lock'), 'a')
+        except IOError:
+            return None
+        fcntl.flock(lock, operation)
+        return lock
+
+
+    def read_cache(self, name):
+        ''' Returns the contents of a cache segment, or None if it can't be read '''
         try:
-            cache = open(self.cache_filename, 'r')
-            json_data = cache.read()
+            cache = open(self.cache_filename(name), 'rb')
+            data = cache.read()
             cache.close()
-            data = json.loads(json_data)
         except IOError:
-            data = {'data': {}, 'inventory': {}}
+            return None
+        if data.startswith('\x1f\x8b'):
+            try:
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                return None
+        return data
+
+
+    def load_from_cache(self, resource):
+        ''' Reads a resource from its cache segment into self.data, if it is there '''
+        data = self.read_cache(resource)
+        if data is not None:
+            try:
+                self.data[resource] = json.loads(data)
+            except ValueError:
+                pass
+
+
+    def inventory_settings(self):
+        ''' The settings the --list inventory depends on, as stored with it.
+        The text of digital_ocean.ini and the maximum age it gives droplets
+        are there for print_cached_list(). '''
+        return json.dumps({'use_private_network': self.use_private_network,
+                           'group_variables': self.group_variables,
+                           'config': self.config_text,
+                           'max_age': self.config_list_max_age}, sort_keys=True)
+
+
+    def load_inventory_from_cache(self, expired=False):
+        ''' Reads the --list inventory stored with the droplets it was built
+        from, if they are still valid (or --force-cache was given, or
+        expired is True) and it was built with the same settings '''
+        if self.args.refresh_cache and not expired:
+            return False
+        lock = self.cache_lock(fcntl.LOCK_SH)
+        try:
+            if not (expired or self.args.force_cache or self.is_cache_valid('droplets')):
+                return False
+            data = self.read_cache('list')
+        finally:
+            if lock:
+                lock.close()
+        if data is None:
+            return False
+        settings, _, inventory = data.partition('\n')
+        if settings != self.inventory_settings():
+            return False
+        try:
+            self.inventory = json.loads(inventory)
+        except ValueError:
+            return False
+        self.inventory_json = inventory
+        return True
 
-        self.data = data['data']
-        self.inventory = data['inventory']
+
+    def find_changes(self):
+        ''' Compares the droplets just fetched with the cached ones by ID, and
+        sets self.changes to the droplets that were added, removed or changed
+        (with the fields that changed) '''
+        try:
+            previous = dict([(d['id'], d) for d in json.loads(self.read_cache('droplets'))])
+        except (TypeError, ValueError, KeyError):
+            return
+
+        current = dict([(d['id'], d) for d in self.data['droplets']])
+        self.changes = {
+            'time': time(),
+            'added': [{'id': i, 'name': current[i]['name']}
+                      for i in sorted(current) if i not in previous],
+            'removed': [{'id': i, 'name': previous[i]['name']}
+                        for i in sorted(previous) if i not in current],
+            'changed': [{'id': i, 'name': current[i]['name'],
+                         'fields': sorted([k for k in set(previous[i]) | set(current[i])
+                                           if previous[i].get(k) != current[i].get(k)])}
+                        for i in sorted(current) if i in previous and previous[i] != current[i]],
+        }
 
 
     def write_to_cache(self):
-        ''' Writes data in JSON format to a file '''
-        data = { 'data': self.data, 'inventory': self.inventory }
-        json_data = json.dumps(data, sort_keys=True, indent=2)
+        ''' Writes the refreshed resources in compact JSON format to their
+        cache segments, along with the --list inventory when the droplets
+        were refreshed (unless stream_inventory() wrote it). The segments
+        are replaced together, under the cache lock. '''
+        writers = self.cache_writers
+        try:
+            for resource in sorted(self.cache_refreshed):
+                if resource in self.data:
+                    writers.append(self.write_segment(resource, json.dumps(self.data[resource], separators=(',', ':'))))
+            if ('droplets' in self.cache_refreshed or 'list' in self.cache_refreshed) and self.streamed_list is None:
+                if not self.inventory:
+                    self.build_inventory()
+                self.inventory_json = json.dumps(self.inventory, separators=(',', ':'))
+                writers.append(self.write_segment('list', self.inventory_settings() + '\n' + self.inventory_json))
+            if self.changes is not None:
+                writers.append(self.write_segment('changes', json.dumps(self.changes, separators=(',', ':'))))
+        except (IOError, OSError) as e:
+            sys.stderr.write('Could not write the cache: %s\n' % e)
+            for writer in writers:
+                writer.abort()
+            return
 
-        cache = open(self.cache_filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        lock = self.cache_lock(fcntl.LOCK_EX)
+        try:
+            while writers:
+                writers[0].commit()
+                writers.pop(0)
+        except OSError as e:
+            sys.stderr.write('Could not write the cache: %s\n' % e)
+            for writer in writers:
+                writer.abort()
+        finally:
+            if lock:
+                lock.close()
+
+
+    def write_segment(self, name, data):
+        ''' Writes a cache segment under its temporary name '''
+        writer = CacheWriter(self.cache_filename(name), self.cache_compress)
+        try:
+            writer.write(data)
+            writer.close()
+        except:
+            writer.abort()
+            raise
+        return writer
 
 
     ###########################################################################
@@ -30,11 +30,35 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import json
 import os
-from sh import bash
+import re
+import select
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from sh import bash, ErrorReturnCode
 
+from ansible.errors import AnsibleError
+from ansible.module_utils._text import to_bytes, to_text
 from ansible.plugins.lookup import LookupBase
 
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# Code shared with the other DIMS plugins
+_PLUGIN_UTILS = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, 'plugin_utils'))
+if _PLUGIN_UTILS not in sys.path:
+    sys.path.insert(0, _PLUGIN_UTILS)
+import dims_plugin_utils
+
 # This lookup sends the arguments passed to it into a Bash shell that
 # has loaded the dims_functions.sh library. It works in a similar manner
 # to the dims.function command. It allows calling the Bash library
@@ -61,11 +85,653 @@ from ansible.plugins.lookup import LookupBase
 # node02.devops.local | SUCCESS => {
 #     "msg": "node02"
 # }
+#
+# By default each process (i.e., each Ansible worker) keeps one Bash
+# coprocess running with shflags and dims_functions.sh already sourced,
+# and sends it one command per call over a pipe, rather than running
+# $DIMS/bin/dims.function (and sourcing the library again) every time.
+# Set DIMS_FUNCTION_BACKEND=exec to go back to running dims.function for
+# every call. A call that takes longer than DIMS_FUNCTION_TIMEOUT seconds
+# (default 30) fails and the coprocess is restarted on the next call.
+# The coprocess is also restarted when the environment has changed since
+# it was started (e.g., a play setting DIMS or PBR), so calls always see
+# the current environment.
+#
+# Results of the functions listed in CACHEABLE are remembered for the
+# life of the process (or for the number of seconds given), keyed on the
+# function, its arguments and the environment variables listed in
+# CACHE_ENVIRONMENT. Only simple calls are cached: a command holding
+# anything the shell would expand or run (e.g., '$(x)', ';', '|') is
+# always evaluated. Other functions are assumed to be impure and run
+# every time. Add to the table with DIMS_FUNCTION_CACHEABLE (e.g.,
+# "get_vagrant_run_dir,get_deployment_from_fqdn:300") or turn caching
+# off with DIMS_FUNCTION_CACHE=off.
+#
+# Because every Ansible fork is a separate process, cached results are
+# also shared between the forks of a run through a locked JSON file in
+# the run's private temporary directory (see
+# plugin_utils/dims_plugin_utils.py). A fork making a call that another
+# fork is running waits for its result instead of running it again.
+# Results in it are kept for at most DIMS_FUNCTION_RUN_CACHE_TTL seconds
+# (default 3600). Set DIMS_FUNCTION_RUN_CACHE to a file name (a file
+# only you can read and write) to share the results between runs as
+# well, or to "off" to keep each fork's cache to itself.
+#
+# A few of the most used functions (see NATIVE) are also implemented in
+# Python and don't need Bash at all. They return exactly what the Bash
+# library returns; for anything they can't reproduce exactly (shell
+# syntax, arguments that look like options to echo, error returns) the
+# call goes to Bash as usual. Pass native=False to always use Bash:
+#
+# {{ lookup('dims_function', 'get_hostname_from_fqdn node01.devops.local', native=False) }}
+#
+# The tests in roles/base/templates/tests/unit/dims-lookups.bats.j2
+# compare the two.
+#
+# Setting DIMS_FUNCTION_TRACE to a file name records every call: the
+# function, the shape of its arguments, wall time, exit status, and
+# whether it was answered from a cache, in Python or by Bash. Each
+# process adds its numbers to the (locked) JSON file when it exits, so the
+# file holds a summary of all forks of a run (and of later runs, until
+# removed). benchmarks/dims_function_bench.py uses it.
+#
+# With batch=True, each term is a separate call rather than part of one
+# command line. All of them are run in one Bash process and the result is
+# a list with one dictionary per term, in order, holding its output and
+# exit status (see LookupModule._run_batch). A failing call doesn't stop
+# the others.
+#
+# - debug: msg="{{ item.term }} -> {{ item.value }}"
+#   with_items: "{{ lookup('dims_function', *commands, batch=True, wantlist=True) }}"
+
+TIMEOUT = 30
+RUN_CACHE_TTL = 3600
+
+# Function name: seconds a result is good for (None: the whole run)
+CACHEABLE = {
+    'get_hostname_from_fqdn': None,
+    'get_ssh_private_key_file': None,
+    'get_packer_box_name': None,
+    'iso8601dateshort': 60,
+}
+
+# Variables the cached functions' results depend on (see get_custom)
+CACHE_ENVIRONMENT = ['DIMS', 'PBR', 'DIMS_PRIVATE']
+
+_UNSAFE = re.compile(r'[$`;&|<>(){}\[\]*?!~\\\n]')
+_GLOB = re.compile(r'[*?\[]')
+_IFS = re.compile(r'[ \t\n]+')
+
+# Each request is the length of the command in bytes on a line by itself,
+# followed by the command. Each reply is a line holding the exit status
+# and the lengths of stdout and stderr, followed by both of them. Commands
+# are run in a subshell, so a function that exits or changes the shell's
+# state doesn't affect later calls. Like dims.function, the command is
+# evaluated unquoted (word splitting and all).
+_COPROCESS_SCRIPT = '''
+[[ -r "$DIMS/lib/shflags" && -r "$DIMS/bin/dims_functions.sh" ]] || exit 127
+. "$DIMS/lib/shflags"
+. "$DIMS/bin/dims_functions.sh"
+# The same flags dims.function defines, for functions that look at them
+DEFINE_boolean 'debug' false 'enable debug mode' 'd'
+DEFINE_boolean 'show-help' false 'show help text' 'H'
+DEFINE_boolean 'usage' false 'print usage information' 'u'
+DEFINE_boolean 'verbose' false 'be verbose' 'v'
+_dims_reply() {
+    # Lengths are in bytes, not characters
+    local LC_ALL=C
+    printf '%d %d %d\\n%s%s' "$1" "${#2}" "${#3}" "$2" "$3"
+}
+_dims_tmp=$1
+trap 'rm -rf "$_dims_tmp"' EXIT
+echo ready
+while IFS= read -r _dims_len; do
+    LC_ALL=C IFS= read -r -N "$_dims_len" _dims_cmd || exit 1
+    ( eval $_dims_cmd ) >"$_dims_tmp/out" 2>"$_dims_tmp/err" </dev/null
+    _dims_rc=$?
+    # Unlike $(...), this keeps trailing newlines
+    IFS= read -r -d '' _dims_out <"$_dims_tmp/out"
+    IFS= read -r -d '' _dims_err <"$_dims_tmp/err"
+    _dims_reply "$_dims_rc" "$_dims_out" "$_dims_err"
+done
+'''
+
+
+class _Coprocess(object):
+    '''A long-lived Bash process with the DIMS function library loaded'''
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.proc = None
+        self.pid = None
+        self.environment = None
+        self.tmp = None
+        self.buffer = b''
+        self.pending = b''
+        self.written = 0
+
+    def start(self):
+        self.stop()
+        # Bash only sees the environment it was started with, so the
+        # coprocess is restarted whenever os.environ changes (see call_many)
+        self.environment = dict(os.environ)
+        # Made here rather than by the script, so stop() can remove it
+        # after killing bash before its EXIT trap runs
+        self.tmp = tempfile.mkdtemp(prefix='dims_function.')
+        self.proc = subprocess.Popen(
+                ['bash', '--noprofile', '--norc', '-c', _COPROCESS_SCRIPT, 'dims_function', self.tmp],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+                env=self.environment)
+        self.pid = os.getpid()
+        self.buffer = b''
+        self.pending = b''
+        self.written = 0
+        if self._readline(time.time() + self.timeout) != b'ready':
+            self.stop()
+            raise AnsibleError('dims_function: could not load $DIMS/lib/shflags '
+                               'and $DIMS/bin/dims_functions.sh')
+
+    def stop(self):
+        # A coprocess inherited from the parent of a forked process is left
+        # alone; the parent is still using it.
+        if self.pid == os.getpid():
+            if self.proc is not None:
+                try:
+                    self.proc.stdin.close()
+                    self.proc.kill()
+                    self.proc.wait()
+                except (IOError, OSError):
+                    pass
+            if self.tmp is not None:
+                shutil.rmtree(self.tmp, ignore_errors=True)
+        self.proc = None
+        self.tmp = None
+
+    def _read(self, deadline):
+        # Requests not yet written are written as the pipe has room, so a
+        # large batch can't fill both pipes and deadlock.
+        fd = self.proc.stdout.fileno()
+        while True:
+            remaining = deadline - time.time()
+            writing = [self.proc.stdin.fileno()] if self.written < len(self.pending) else []
+            if remaining > 0:
+                readable, writable = select.select([fd], writing, [], remaining)[:2]
+            else:
+                readable = writable = []
+            if not readable and not writable:
+                raise AnsibleError('dims_function: timed out after {0}s'.format(self.timeout))
+            if writable:
+                self.written += os.write(self.proc.stdin.fileno(),
+                                         self.pending[self.written:self.written + select.PIPE_BUF])
+            if readable:
+                break
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            raise AnsibleError('dims_function: coprocess exited unexpectedly')
+        self.buffer += chunk
+
+    def _readline(self, deadline):
+        while b'\n' not in self.buffer:
+            self._read(deadline)
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line
+
+    def _readbytes(self, count, deadline):
+        while len(self.buffer) < count:
+            self._read(deadline)
+        data, self.buffer = self.buffer[:count], self.buffer[count:]
+        return data
+
+    def call(self, command):
+        '''Return (exit status, stdout, stderr) of running command'''
+        return self.call_many([command])[0]
+
+    def call_many(self, commands):
+        '''Return a list of (exit status, stdout, stderr), one per command
+
+        All of the commands are sent at once and run one after the other.
+        The timeout applies to each of them.
+        '''
+        if (self.proc is None or self.pid != os.getpid() or self.proc.poll() is not None or
+                self.environment != os.environ):
+            self.start()
+        requests = []
+        for command in commands:
+            data = to_bytes(command)
+            requests.append('{0}\n'.format(len(data)).encode('utf-8') + data)
+        self.pending = b''.join(requests)
+        self.written = 0
+        results = []
+        try:
+            for command in commands:
+                deadline = time.time() + self.timeout
+                rc, out_len, err_len = [int(i) for i in self._readline(deadline).split()]
+                out = self._readbytes(out_len, deadline)
+                err = self._readbytes(err_len, deadline)
+                results.append((rc,
+                                to_text(out, errors='surrogate_or_replace'),
+                                to_text(err, errors='surrogate_or_replace')))
+        except Exception:
+            # Whatever state the coprocess is in, it can't be trusted now
+            self.stop()
+            raise
+        return results
+
+
+_coprocess = None
+
+
+def _get_coprocess():
+    global _coprocess
+    timeout = float(os.getenv('DIMS_FUNCTION_TIMEOUT', TIMEOUT))
+    if _coprocess is None:
+        _coprocess = _Coprocess(timeout=timeout)
+    _coprocess.timeout = timeout
+    return _coprocess
+
+
+_results = {}
+
+
+def _cacheable():
+    table = dict(CACHEABLE)
+    for item in os.getenv('DIMS_FUNCTION_CACHEABLE', '').split(','):
+        name, sep, ttl = item.strip().partition(':')
+        if name:
+            table[name] = float(ttl) if ttl else None
+    return table
+
+
+def _cache_key(command):
+    '''Return (key, ttl) for a cacheable command, else (None, None)'''
+    if os.getenv('DIMS_FUNCTION_CACHE', 'on').lower() in ['off', 'no', 'false', '0']:
+        return None, None
+    if _UNSAFE.search(command):
+        return None, None
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None, None
+    table = _cacheable()
+    if not words or words[0] not in table:
+        return None, None
+    env = tuple([os.getenv(name) for name in CACHE_ENVIRONMENT])
+    return (tuple(words), env), table[words[0]]
+
+
+def _split(value):
+    '''Split value into words the way Bash does with the default $IFS'''
+    return [word for word in _IFS.split(value) if word]
+
+
+def _get_custom():
+    custom = os.getenv('DIMS_PRIVATE') or os.getenv('PBR') or '__undefined__'
+    if _GLOB.search(custom):
+        return None
+    return ' '.join(_split(custom))
+
+
+def _native_echo(args):
+    if args and args[0].startswith('-'):
+        return None
+    return ' '.join(args) + '\n'
+
+
+def _native_say(args):
+    words = _split(' '.join(args))
+    if words and words[0].startswith('-'):
+        return None
+    return '[+] ' + ' '.join(words) + '\n'
+
+
+def _native_say_raw(args):
+    return '[+] ' + (args[0] if args else '')
+
+
+def _native_iso8601dateshort(args):
+    return time.strftime('%Y-%m-%dT%H:%M:%S%Z') + '\n'
+
+
+def _native_get_hostname_from_fqdn(args):
+    fqdn = (args[0] if args else '') or os.getenv('FQDN', '')
+    if not fqdn:
+        # Bash returns 1 here; let it raise the error
+        return None
+    words = _split(fqdn)
+    if not words:
+        return '\n'
+    if words[0].startswith('-'):
+        return None
+    fields = _split(words[0].replace('.', ' '))
+    if len(fields) < 2:
+        return '\n'
+    return fields[0] + '\n'
+
+
+def _native_get_ssh_private_key_file(args):
+    user = args[0] if args else ''
+    custom = args[1] if len(args) > 1 and args[1] else _get_custom()
+    if custom is None:
+        return None
+    kfile = '{0}/files/ssh-keys/user/{1}/dims_{1}_rsa'.format(custom, user)
+    if not os.path.isfile(kfile):
+        return '\n'
+    if kfile.startswith('-'):
+        return None
+    return ' '.join(_split(kfile)) + '\n'
+
+
+# Function name: Python version returning its stdout (None: use Bash)
+NATIVE = {
+    'echo': _native_echo,
+    'say': _native_say,
+    'say_raw': _native_say_raw,
+    'iso8601dateshort': _native_iso8601dateshort,
+    'get_hostname_from_fqdn': _native_get_hostname_from_fqdn,
+    'get_ssh_private_key_file': _native_get_ssh_private_key_file,
+}
+
+
+def _run_native(command):
+    '''Return the stdout of command run in Python, or None'''
+    if _UNSAFE.search(command) or '#' in command or '\r' in command:
+        return None
+    try:
+        # Like dims.function, split on whitespace before evaluating
+        words = shlex.split(' '.join(_split(command)))
+    except ValueError:
+        return None
+    if not words or words[0] not in NATIVE:
+        return None
+    return NATIVE[words[0]](words[1:])
+
+
+def _cache_get(key):
+    cached = _results.get(key)
+    if cached is not None and (cached[0] is None or cached[0] > time.time()):
+        return list(cached[1])
+    return None
+
+
+def _cache_put(key, ttl, results):
+    expires = None if ttl is None else time.time() + ttl
+    _results[key] = (expires, list(results))
+
+
+_run_cache = None
+
+
+def _get_run_cache():
+    '''Return the cache shared by the forks of this run, or None if it is disabled'''
+    global _run_cache
+    if os.getenv('DIMS_FUNCTION_CACHE', 'on').lower() in ['off', 'no', 'false', '0']:
+        return None
+    path = os.getenv('DIMS_FUNCTION_RUN_CACHE')
+    if path is not None and path.lower() in ('', 'off', 'no', 'false', '0'):
+        return None
+    if path is None:
+        path = dims_plugin_utils.run_path('function.json')
+    if _run_cache is None or _run_cache.path != path:
+        _run_cache = dims_plugin_utils.SharedCache(path)
+    # A call in flight in another fork is waited for as long as it may run
+    _run_cache.wait = float(os.getenv('DIMS_FUNCTION_TIMEOUT', TIMEOUT))
+    return _run_cache
+
+
+def _shared(keys, compute):
+    '''Same as compute(list(keys)), answering from the run cache where possible
+
+    keys maps each key (see _cache_key) to its TTL (None: the whole run).
+    compute is passed the list of missing keys and returns {key: lines}
+    for those that succeeded; failures aren't cached.
+    '''
+    cache = _get_run_cache()
+    if cache is None:
+        return compute(list(keys))
+    run_ttl = float(os.getenv('DIMS_FUNCTION_RUN_CACHE_TTL', RUN_CACHE_TTL))
+    names = dict([(json.dumps(key), key) for key in keys])
+
+    def compute_named(missing):
+        computed = compute([names[n] for n in missing])
+        return dict([(json.dumps(key), (lines, run_ttl if keys[key] is None else min(keys[key], run_ttl)))
+                     for key, lines in computed.items()])
+
+    try:
+        found = cache.get(names, compute_named)
+    except (IOError, OSError) as e:
+        display.vvv('dims_function cache {0} unusable: {1}'.format(cache.path, str(e)))
+        return compute(list(keys))
+    return dict([(names[n], lines) for n, lines in found.items()])
+
+
+TRACE_SOURCES = ['memory', 'run_cache', 'native', 'bash']
+
+
+def _shape(command):
+    '''Return (function, shape of its arguments) for a command line'''
+    words = _split(command)
+    if not words:
+        return '', 'empty'
+    shape = '{0} args'.format(len(words) - 1)
+    if _UNSAFE.search(command):
+        shape += ', shell syntax'
+    return words[0], shape
+
+
+class _Trace(dims_plugin_utils.CallStats):
+    '''
+    Per-function call statistics (see dims_plugin_utils.CallStats). Besides
+    the common fields, each function's entry counts its calls by source
+    (see TRACE_SOURCES), by exit status and by argument shape. Its hits and
+    misses are those of cacheable calls.
+    '''
+
+    counted = ('sources', 'status', 'shapes')
+
+    def record(self, command, elapsed, status, source, cacheable):
+        function, shape = _shape(command)
+        entry = self.entry(function, elapsed)
+        for field, value in (('sources', source), ('status', str(status)), ('shapes', shape)):
+            entry[field][value] = entry[field].get(value, 0) + 1
+        if source in ('memory', 'run_cache'):
+            entry['hits'] += 1
+        elif cacheable:
+            entry['misses'] += 1
+
+    def record_batch(self, results, elapsed):
+        '''Record the items of a batch, sharing its wall time among them'''
+        for result in results:
+            self.record(result['term'], elapsed / len(results), result['rc'],
+                        result['source'], result['cacheable'])
+
+
+_trace = None
+
+
+def _get_trace():
+    '''Return the _Trace collector for this process, or None if tracing is off'''
+    global _trace
+    path = os.getenv('DIMS_FUNCTION_TRACE')
+    if not path:
+        return None
+    if _trace is None or _trace.path != path:
+        _trace = _Trace(path)
+    return _trace
+
+
+def _flatten(terms):
+    commands = []
+    for term in terms:
+        if isinstance(term, (list, tuple)):
+            commands.extend(_flatten(term))
+        else:
+            commands.append(term)
+    return commands
+
 
 class LookupModule(LookupBase):
 
     def run(self, terms, variables=None, **kwargs):
 
+        native = kwargs.get('native', True)
+        trace = _get_trace()
+        start = time.time()
+        if kwargs.get('batch', False):
+            results = self._run_batch(_flatten(terms), native)
+            if trace is not None:
+                trace.record_batch(results, time.time() - start)
+            return results
+
+        command = ' '.join([term for term in terms])
+        if trace is None:
+            return self._run_single(terms, command, native)[0]
+        try:
+            results, source, cacheable = self._run_single(terms, command, native)
+        except Exception as e:
+            trace.record(command, time.time() - start,
+                         getattr(e, 'rc', getattr(e, 'exit_code', None)), 'bash', False)
+            raise
+        trace.record(command, time.time() - start, 0, source, cacheable)
+        return results
+
+    def _run_single(self, terms, command, native=True):
+        '''Return (results, source, cacheable) for one command line'''
+
+        if not native:
+            return self._run(terms, command), 'bash', False
+
+        key, ttl = _cache_key(command)
+        if key is not None:
+            cached = _cache_get(key)
+            if cached is not None:
+                return cached, 'memory', True
+
+        out = _run_native(command)
+        if out is not None:
+            results = [line.strip() for line in out.splitlines()]
+            source = 'native'
+        elif key is not None:
+            ran = []
+
+            def compute(missing):
+                ran.append(True)
+                return {key: self._run(terms, command)}
+
+            results = _shared({key: ttl}, compute)[key]
+            source = 'bash' if ran else 'run_cache'
+        else:
+            results = self._run(terms, command)
+            source = 'bash'
+        if key is not None:
+            _cache_put(key, ttl, results)
+        return results, source, key is not None
+
+    def _run_batch(self, commands, native=True):
+        '''Run each command separately, returning a list of results
+
+        Commands that aren't cached or answered in Python are all sent to
+        one Bash process. Failures don't raise an error; each result is a
+        dictionary like:
+
+            {'term': 'get_hostname_from_fqdn node01.devops.local',
+             'rc': 0,
+             'failed': False,
+             'lines': ['node01'],
+             'value': 'node01',
+             'error': '',
+             'source': 'native',
+             'cacheable': True}
+
+        where 'value' is what lookup() would return for the command alone
+        and 'source' is where the answer came from: 'memory' (this process'
+        cache), 'run_cache' (the cache shared by the forks of the run),
+        'native' (Python) or 'bash'.
+        '''
+        outcomes = [None] * len(commands)
+        keys = [(None, None)] * len(commands)
+        todo = []
+        for i, command in enumerate(commands):
+            if native:
+                keys[i] = _cache_key(command)
+                if keys[i][0] is not None:
+                    cached = _cache_get(keys[i][0])
+                    if cached is not None:
+                        outcomes[i] = (0, cached, '', 'memory')
+                        continue
+                out = _run_native(command)
+                if out is not None:
+                    outcomes[i] = (0, [line.strip() for line in out.splitlines()], '', 'native')
+                    continue
+            todo.append(i)
+
+        # Calls that can be cached are shared with the other forks; only
+        # those no fork has made yet are run here.
+        keyed = [i for i in todo if keys[i][0] is not None]
+        if keyed:
+            first = {}
+            for i in keyed:
+                first.setdefault(keys[i][0], i)
+
+            def compute(missing):
+                indexes = [first[key] for key in missing]
+                self._execute(commands, indexes, outcomes)
+                return dict([(keys[i][0], outcomes[i][1])
+                             for i in indexes if outcomes[i][0] == 0])
+
+            found = _shared(dict([keys[i] for i in keyed]), compute)
+            for i in keyed:
+                if outcomes[i] is None and keys[i][0] in found:
+                    outcomes[i] = (0, found[keys[i][0]], '', 'run_cache')
+        self._execute(commands, [i for i in todo if outcomes[i] is None], outcomes)
+
+        results = []
+        for command, (key, ttl), (rc, lines, err, source) in zip(commands, keys, outcomes):
+            if rc == 0 and key is not None:
+                _cache_put(key, ttl, lines)
+            results.append({
+                'term': command,
+                'rc': rc,
+                'failed': rc != 0,
+                'lines': lines,
+                'value': ','.join(lines),
+                'error': err.strip(),
+                'source': source,
+                'cacheable': key is not None,
+            })
+        return results
+
+    def _execute(self, commands, indexes, outcomes):
+        '''Run commands[i] in Bash for each i in indexes, setting outcomes[i]'''
+        if not indexes:
+            return
+        if os.getenv('DIMS_FUNCTION_BACKEND', 'coprocess') == 'exec':
+            for i in indexes:
+                try:
+                    outcomes[i] = (0, self._run_exec([commands[i]]), '', 'bash')
+                except ErrorReturnCode as e:
+                    outcomes[i] = (e.exit_code, [], to_text(e.stderr, errors='surrogate_or_replace'), 'bash')
+        else:
+            replies = _get_coprocess().call_many([commands[i] for i in indexes])
+            for i, (rc, out, err) in zip(indexes, replies):
+                outcomes[i] = (rc, [line.strip() for line in out.splitlines()], err, 'bash')
+
+    def _run(self, terms, command):
+
+        if os.getenv('DIMS_FUNCTION_BACKEND', 'coprocess') == 'exec':
+            return self._run_exec(terms)
+
+        rc, out, err = _get_coprocess().call(command)
+        if rc != 0:
+            error = AnsibleError('dims_function: "{0}" returned {1}: {2}'.format(
+                command, rc, err.strip()))
+            error.rc = rc
+            raise error
+        return [line.strip() for line in out.splitlines()]
+
+    def _run_exec(self, terms):
+
         results = []
         _dims_function = "{}/bin/dims.function".format(
                 os.getenv('DIMS', '')
@@ -0,0 +1,307 @@
+# vim: set ts=4 sw=4 tw=0 et :
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import atexit
+import errno
+import fcntl
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import random
+import stat
+import time
+
+from ansible import constants as C
+
+# Code shared by the DIMS plugins (filter_plugins/dims_filters.py and
+# lookup_plugins/dims_function.py). Ansible loads each plugin from its own
+# directory by file name, so the plugins add this directory to sys.path
+# and import this module as dims_plugin_utils.
+
+RUN_FILE_PREFIX = 'dims_'
+
+
+def open_private(path):
+    '''
+    Open the file at path for reading and writing, creating it (mode 0600)
+    if needed, and return it as a file object. Symbolic links are not
+    followed, and OSError is raised if the file is not a regular file
+    owned by the current user that only that user can read and write, so
+    another user can't plant data in it.
+    '''
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise OSError(errno.EPERM, 'not a private file of this user', path)
+    except Exception:
+        os.close(fd)
+        raise
+    return os.fdopen(fd, 'r+')
+
+
+def run_path(name):
+    '''
+    Return the path of a file shared by the processes of this Ansible run
+    (the controller and its forks). It is in the directory the controller
+    creates for the run under local_tmp (~/.ansible/tmp) with mode 0700 and
+    a random name, which the forks inherit, and is removed when the
+    controller exits.
+    '''
+    return os.path.join(C.DEFAULT_LOCAL_TMP, RUN_FILE_PREFIX + name)
+
+
+def _remove_run_files():
+    # Forks exit while the run goes on; only the controller cleans up
+    if multiprocessing.current_process().name != 'MainProcess':
+        return
+    try:
+        names = os.listdir(C.DEFAULT_LOCAL_TMP)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(RUN_FILE_PREFIX):
+            try:
+                os.unlink(os.path.join(C.DEFAULT_LOCAL_TMP, name))
+            except OSError:
+                pass
+
+
+if multiprocessing.current_process().name == 'MainProcess':
+    atexit.register(_remove_run_files)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class SharedCache(object):
+    '''
+    A cache of JSON values shared by several processes through a file
+    (see open_private()). The file is locked (fcntl.flock) while it is
+    read and updated, but not while missing values are computed: they are
+    marked as in flight instead, and other processes that need one of them
+    wait (for up to wait seconds) for it to be stored rather than compute
+    it again. Values that are already cached are returned at once.
+
+    The file holds {"entries": {key: [value, expires, last_used]},
+    "pending": {key: [pid, since]}}. The least recently used entries are
+    dropped beyond max_entries.
+    '''
+
+    def __init__(self, path, max_entries=None, wait=30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.wait = wait
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, f):
+        f.seek(0)
+        try:
+            state = json.loads(f.read() or '{}')
+        except ValueError:
+            state = {}
+        if not isinstance(state, dict) or not isinstance(state.get('entries'), dict):
+            state = {'entries': {}}
+        if not isinstance(state.get('pending'), dict):
+            state['pending'] = {}
+        return state
+
+    def _save(self, f, state):
+        entries = state['entries']
+        if self.max_entries is not None and len(entries) > self.max_entries:
+            for key in sorted(entries, key=lambda k: entries[k][2])[:len(entries) - self.max_entries]:
+                del entries[key]
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state, separators=(',', ':')))
+        f.flush()
+
+    def _update(self, f, update):
+        '''Call update(state, now) with the file locked, which returns
+        (result, changed), and save the state if it changed'''
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            state = self._load(f)
+            result, changed = update(state, now)
+            if changed:
+                self._save(f, state)
+            return result
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, keys, compute):
+        '''Return {key: value} for keys (strings), calling compute() for missing ones
+
+        compute is passed a list of missing keys and returns {key: (value,
+        ttl)} for those it has a value for; the others are left out of the
+        result and aren't cached.
+        '''
+        pid = os.getpid()
+        found = {}
+        waiting = sorted(set(keys))
+        delay = 0.01
+
+        def claim(state, now):
+            entries = state['entries']
+            pending = state['pending']
+            changed = False
+            for key in list(entries):
+                if entries[key][1] <= now:
+                    del entries[key]
+                    changed = True
+            for key, (owner, since) in list(pending.items()):
+                if owner == pid or since + self.wait <= now or not _alive(owner):
+                    del pending[key]
+                    changed = True
+            mine = []
+            others = []
+            for key in waiting:
+                if key in entries:
+                    found[key] = entries[key][0]
+                    if self.max_entries is not None:
+                        entries[key][2] = now
+                        changed = True
+                elif key in pending:
+                    others.append(key)
+                else:
+                    pending[key] = [pid, now]
+                    mine.append(key)
+                    changed = True
+            return (mine, others), changed
+
+        with open_private(self.path) as f:
+            while waiting:
+                mine, others = self._update(f, claim)
+                self.hits += len(waiting) - len(mine) - len(others)
+                self.misses += len(mine)
+                if mine:
+                    computed = {}
+
+                    def store(state, now):
+                        for key in mine:
+                            if state['pending'].get(key, [None])[0] == pid:
+                                del state['pending'][key]
+                        for key, (value, ttl) in computed.items():
+                            state['entries'][key] = [value, now + ttl, now]
+                        return None, True
+
+                    try:
+                        computed = compute(mine)
+                    finally:
+                        self._update(f, store)
+                    for key, (value, ttl) in computed.items():
+                        found[key] = value
+                waiting = others
+                if waiting:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.2)
+        return found
+
+
+class CallStats(object):
+    '''
+    Call statistics for one process, added to a shared JSON file (see
+    open_private()) when the process exits, so the file holds the totals
+    of all processes that used it. Each entry holds calls, seconds
+    (cumulative), p95 (seconds), a bounded sample of latencies used to
+    compute p95 across processes, and cache hits and misses (and
+    hit_rate).
+
+    Subclasses name further fields: summed (numbers added up), maxed
+    (numbers whose maximum is kept) and counted (counts per value).
+    '''
+
+    samples = 1000
+    summed = ('calls', 'seconds', 'hits', 'misses')
+    maxed = ()
+    counted = ()
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.stats = {}
+        atexit.register(self.flush)
+
+    def _reset(self):
+        # A fork starts with a copy of the parent's numbers, which the
+        # parent reports itself. multiprocessing runs its finalizers when a
+        # worker process ends, but not atexit.
+        self.pid = os.getpid()
+        self.stats = {}
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def entry(self, name, elapsed):
+        '''Count a call of name that took elapsed seconds and return its entry'''
+        if self.pid != os.getpid():
+            self._reset()
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = dict([(field, 0) for field in self.summed + self.maxed])
+            entry.update([(field, {}) for field in self.counted])
+            entry['samples'] = []
+            self.stats[name] = entry
+        entry['calls'] += 1
+        entry['seconds'] += elapsed
+        if len(entry['samples']) < self.samples:
+            entry['samples'].append(elapsed)
+        else:
+            # Reservoir sampling keeps the sample representative
+            i = random.randint(0, entry['calls'] - 1)
+            if i < self.samples:
+                entry['samples'][i] = elapsed
+        return entry
+
+    def _merge(self, old, new):
+        merged = dict(old)
+        for field in self.summed:
+            merged[field] = old.get(field, 0) + new[field]
+        for field in self.maxed:
+            merged[field] = max(old.get(field, 0), new[field])
+        for field in self.counted:
+            counts = dict(old.get(field, {}))
+            for value, count in new[field].items():
+                counts[value] = counts.get(value, 0) + count
+            merged[field] = counts
+        samples = old.get('samples', []) + new['samples']
+        if len(samples) > self.samples:
+            samples = random.sample(samples, self.samples)
+        merged['samples'] = samples
+        ordered = sorted(samples)
+        merged['p95'] = ordered[int(0.95 * (len(ordered) - 1))] if ordered else 0.0
+        lookups = merged['hits'] + merged['misses']
+        merged['hit_rate'] = float(merged['hits']) / lookups if lookups else None
+        return merged
+
+    def flush(self):
+        '''Add this process' statistics to the shared file'''
+        if not self.stats or self.pid != os.getpid():
+            return
+        try:
+            with open_private(self.path) as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    try:
+                        totals = json.loads(f.read() or '{}')
+                    except ValueError:
+                        totals = {}
+                    for name, entry in self.stats.items():
+                        totals[name] = self._merge(totals.get(name, {}), entry)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(totals, sort_keys=True, indent=2))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except (IOError, OSError):
+            pass
+        self.stats = {}
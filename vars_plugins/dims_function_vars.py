@@ -0,0 +1,99 @@
+# vim: set ts=4 sw=4 tw=0 et :
+#
+# Copyright (C) 2014-2016, University of Washington. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from ansible.errors import AnsibleError
+from ansible.module_utils._text import to_text
+from ansible.module_utils.six import string_types, text_type
+from ansible.template import Templar
+from ansible.utils.vars import combine_vars
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+    display = Display()
+
+# Inventory variables such as ansible_ssh_private_key_file are defined as
+# lookup('dims_function', ...) expressions, which Ansible templates again
+# (and so runs Bash again) every time the variable is used. This plugin
+# templates them once per host while the inventory is being loaded and
+# sets the results as plain host variables.
+#
+# Only the variables listed in the inventory variable dims_function_vars
+# are resolved, e.g. in inventory/all.yml:
+#
+#   all:
+#     vars:
+#       ansible_user: 'ansible'
+#       ansible_ssh_private_key_file: "{{ lookup('dims_function', 'get_ssh_private_key_file {{ ansible_user }} {{ dims_private }}') }}"
+#       dims_function_vars: [ 'ansible_ssh_private_key_file' ]
+#
+# A variable that can't be resolved for a host (e.g., it refers to another
+# variable the host doesn't define) is left alone and is templated when it
+# is used, as before.
+#
+# The values become inventory host variables, so a listed variable must
+# not also be set in group_vars/ files (which they would now override).
+#
+# This plugin is found through the vars_plugins setting in ansible.cfg
+# (see roles/ansible-server/templates/ansible.cfg/ansible.cfg.j2).
+
+OWNER_VARIABLE = 'dims_function_vars'
+
+
+class VarsModule(object):
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def run(self, host, vault_password=None):
+        '''Return the variables listed in dims_function_vars, templated'''
+
+        variables = combine_vars(host.get_group_vars(), host.get_vars())
+        owned = variables.get(OWNER_VARIABLE) or []
+        if isinstance(owned, string_types):
+            owned = [owned]
+
+        templar = Templar(loader=self.inventory._loader, variables=variables)
+        results = {}
+        for name in owned:
+            if name not in variables:
+                continue
+            try:
+                value = templar.template(variables[name], fail_on_undefined=True)
+            except AnsibleError as e:
+                display.vvv('dims_function_vars: {0} left unresolved for {1}: {2}'.format(
+                    name, host.name, to_text(e)))
+                continue
+            # Lookup results are marked unsafe; store a plain string
+            results[name] = text_type(value) if isinstance(value, string_types) else value
+        return results